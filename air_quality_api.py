@@ -5,218 +5,505 @@ air_quality_api.py - 簡潔時間版
 只顯示純粹的時間，不加任何標籤
 """
 
-import requests
 import hmac
+import math
+import logging
 import hashlib
 import time
 import datetime
 import os
-from typing import Dict, Optional, Tuple
+import re
+import threading
+from array import array
+from collections import OrderedDict
+from bisect import bisect_left
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
+from typing import TYPE_CHECKING, Callable, Dict, Iterator, List, Optional, Tuple
 from zoneinfo import ZoneInfo
 
+if TYPE_CHECKING:
+    import requests
+
+# orjson 解析較快；未安裝時退回標準函式庫（json.loads 同樣接受 bytes）
+try:
+    import orjson
+except ImportError:
+    import json as orjson
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
 # LSID 對應
 AIRLINK_LSIDS = {
     652269: "南區上",
     655484: "南區下"
 }
 
+# 環保署目標測站
+MOENV_TARGETS = frozenset({"仁武", "楠梓"})
+
+# 環保署 API 伺服器端篩選：同一欄位多個值以逗號分隔（OR），不同條件以 | 串接（AND）
+MOENV_SITE_FILTER = "sitename,EQ," + ",".join(sorted(MOENV_TARGETS))
+
 # 台灣時區
 TW_TZ = ZoneInfo("Asia/Taipei")
 
+# AirLink PM 欄位優先順序：即時 API 以 _last 為主，歷史 API 以 _avg 為主
+CURRENT_PM25_FIELDS = ("pm_2p5_last", "pm_2p5")
+CURRENT_PM10_FIELDS = ("pm_10_last", "pm_10")
+HISTORIC_PM25_FIELDS = ("pm_2p5_avg", "pm_2p5", "pm_2p5_last")
+HISTORIC_PM10_FIELDS = ("pm_10_avg", "pm_10", "pm_10_last")
+
+def first_not_none(record: Dict, keys: Tuple[str, ...]):
+    """依序取第一個非 None 的欄位值（0.0 視為有效讀值）"""
+    for key in keys:
+        value = record.get(key)
+        if value is not None:
+            return value
+    return None
+
+def round1(value) -> Optional[float]:
+    """四捨五入到小數一位（None 保持 None，0.0 為有效讀值）"""
+    return None if value is None else round(value, 1)
+
+def iter_airlink_sensors(data: Dict) -> Iterator[Tuple[str, List[Dict]]]:
+    """只走訪 AIRLINK_LSIDS 內的感應器，回傳 (測站名稱, 資料列)；全部找到即停止"""
+    remaining = len(AIRLINK_LSIDS)
+    for sensor in data.get("sensors", ()):
+        name = AIRLINK_LSIDS.get(sensor.get("lsid"))
+        if name is None:
+            continue
+        sensor_data = sensor.get("data")
+        if sensor_data:
+            yield name, sensor_data
+        remaining -= 1
+        if not remaining:
+            return
+
+# 歷史資料欄位：{測站名稱: (ts, PM2.5, PM10)}，缺值為 NaN
+HistoricColumns = Dict[str, Tuple[array, array, array]]
+
+def historic_columns(data: Dict) -> HistoricColumns:
+    """Historic API 回應只取出時間與 PM 值存成陣列（完整 JSON 一天可達數 MB，快取只保留需要的欄位）"""
+    columns = {}
+    for name, sensor_data in iter_airlink_sensors(data):
+        ts_col, pm25_col, pm10_col = array("q"), array("d"), array("d")
+        for record in sensor_data:
+            ts = record.get("ts")
+            if not ts:
+                continue
+            pm25 = first_not_none(record, HISTORIC_PM25_FIELDS)
+            pm10 = first_not_none(record, HISTORIC_PM10_FIELDS)
+            if pm25 is None and pm10 is None:
+                continue
+            ts_col.append(ts)
+            pm25_col.append(math.nan if pm25 is None else pm25)
+            pm10_col.append(math.nan if pm10 is None else pm10)
+        columns[name] = (ts_col, pm25_col, pm10_col)
+    return columns
+
+# 環保署無效值標記：完全相符 / 出現在字串中（historical_query 向量化清理共用同一個 regex）
+_INVALID_EXACT = frozenset({'#', '*', 'x', 'A', 'NR', 'ND', '', '-'})
+_INVALID_CHARS = frozenset('#*xA-')
+INVALID_MARKER_RE = re.compile(r'[#*xA\-]|NR|ND')
+
+# 共用連線（保持 keep-alive，避免每次查詢重新 TLS 握手）
+# requests 延到第一次連線時才 import（單獨使用本模組、不需連線時不必載入）
+@lru_cache(maxsize=None)
+def get_session() -> "requests.Session":
+    """取得共用的 requests.Session（weatherlink.com、data.moenv.gov.tw 皆經由此連線池）"""
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    
+    session = requests.Session()
+    session.headers.update({"Accept-Encoding": "gzip", "Connection": "keep-alive"})
+    session.mount("https://", HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        # 不依 Retry-After 等待（可能長達數小時並占住 worker 與快取鎖），只用短暫退避重試
+        max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504],
+                          respect_retry_after_header=False)
+    ))
+    return session
+
+# 環保署憑證驗證：預設使用系統/certifi 憑證，若中繼憑證不完整可用 MOENV_CA_BUNDLE 指定憑證鏈檔案
+MOENV_VERIFY = os.getenv('MOENV_CA_BUNDLE') or True
+
+# 即時資料快取（秒數對應上游更新頻率）
+AIRLINK_CACHE_TTL = 300
+MOENV_CACHE_TTL = 600
+# 歷史資料快取：已結束的日期資料不會再變動，含今天的時間窗則與即時資料同步更新
+# （歷史資料只快取 historic_columns 取出的欄位陣列，每天每測站約數十 KB）
+HISTORIC_CACHE_TTL = 86400
+CACHE_MAX_ENTRIES = 128
+_CACHE: "OrderedDict[tuple, Tuple[float, Dict]]" = OrderedDict()
+_CACHE_LOCK = threading.Lock()
+_KEY_LOCKS: Dict[tuple, threading.Lock] = {}
+
+def cached(key: tuple, ttl: float, fn: Callable[..., Optional[Dict]], *args) -> Optional[Dict]:
+    """TTL + LRU 快取：在有效期間內直接回傳上次成功的結果（失敗結果不快取）"""
+    with _CACHE_LOCK:
+        entry = _CACHE.get(key)
+        if entry and time.monotonic() < entry[0]:
+            _CACHE.move_to_end(key)
+            return entry[1]
+        # 未命中才建立 key 鎖
+        key_lock = _KEY_LOCKS.setdefault(key, threading.Lock())
+    
+    # 同一個 key 同時只有一個執行緒呼叫 API，其餘等待並共用結果
+    with key_lock:
+        with _CACHE_LOCK:
+            entry = _CACHE.get(key)
+        if entry and time.monotonic() < entry[0]:
+            return entry[1]
+        
+        expires_at = time.monotonic() + ttl
+        result = fn(*args)
+        if result:
+            with _CACHE_LOCK:
+                _CACHE[key] = (expires_at, result)
+                _CACHE.move_to_end(key)
+                # 超過上限時淘汰最久未使用的項目
+                while len(_CACHE) > CACHE_MAX_ENTRIES:
+                    old_key, _ = _CACHE.popitem(last=False)
+                    _KEY_LOCKS.pop(old_key, None)
+        else:
+            # 失敗結果不快取，鎖也一併移除（避免失敗的 key 累積）
+            with _CACHE_LOCK:
+                if _KEY_LOCKS.get(key) is key_lock:
+                    del _KEY_LOCKS[key]
+        return result
+
+def cache_peek(key: tuple) -> Optional[Dict]:
+    """只讀取快取中仍有效的結果（不呼叫 API、不等待 key 鎖），未命中回傳 None"""
+    with _CACHE_LOCK:
+        entry = _CACHE.get(key)
+        if entry and time.monotonic() < entry[0]:
+            _CACHE.move_to_end(key)
+            return entry[1]
+    return None
+
+def historic_cache_ttl(end_ts: int) -> int:
+    """歷史時間窗的快取秒數：結束於今天（台灣時間）之前者視為不再變動"""
+    today_start = datetime.datetime.combine(datetime.datetime.now(TW_TZ).date(), datetime.time.min, tzinfo=TW_TZ)
+    return HISTORIC_CACHE_TTL if end_ts <= today_start.timestamp() else AIRLINK_CACHE_TTL
+
+def invalidate_cache() -> None:
+    """清除資料快取，下次查詢會重新呼叫 API"""
+    with _CACHE_LOCK:
+        _CACHE.clear()
+        _KEY_LOCKS.clear()
+    with _MESSAGE_CACHE_LOCK:
+        _MESSAGE_CACHE.clear()
+
+# 時間顯示格式化：多個測站通常共用同一時間，結果依輸入快取
+@lru_cache(maxsize=256)
+def _format_ts(ts: int) -> str:
+    """Unix 時間戳記 → 台灣時間（MM/DD HH:MM）"""
+    return datetime.datetime.fromtimestamp(ts, tz=TW_TZ).strftime("%m/%d %H:%M")
+
+@lru_cache(maxsize=256)
+def _format_publish_time(publish_time: str) -> str:
+    """環保署 publishtime → MM/DD HH:MM，無法解析時原樣顯示"""
+    try:
+        # fromisoformat 為 C 實作，可解析 "YYYY-MM-DD HH:MM[:SS]"
+        return datetime.datetime.fromisoformat(publish_time).strftime("%m/%d %H:%M")
+    except ValueError:
+        return publish_time
+
+# 已完成金鑰初始化的 HMAC 物件（依 api_secret 快取，簽名時 copy 使用）
+_HMAC_TEMPLATES: Dict[str, "hmac.HMAC"] = {}
+
+def hmac_for(api_secret: str) -> "hmac.HMAC":
+    """取得以 api_secret 為金鑰的 HMAC-SHA256 副本，省去每次的金鑰 padding 計算"""
+    template = _HMAC_TEMPLATES.get(api_secret)
+    if template is None:
+        template = hmac.new(api_secret.encode(), None, hashlib.sha256)
+        _HMAC_TEMPLATES[api_secret] = template
+    return template.copy()
+
+# API 簽名的 t 以 30 秒為單位，同一區間內簽名可直接重用（Current 與 Historic 共用）
+SIGNATURE_WINDOW = 30
+
+@lru_cache(maxsize=32)
 def generate_current_signature(api_key: str, api_secret: str, t: int, station_id: str) -> str:
     """生成 Current API 簽名"""
-    parts = ["api-key", api_key, "station-id", str(station_id), "t", str(t)]
-    data = "".join(parts)
-    return hmac.new(api_secret.encode(), data.encode(), hashlib.sha256).hexdigest()
+    # 欄位皆為 ASCII，一個 f-string 組好再編碼一次
+    data = f"api-key{api_key}station-id{station_id}t{t}".encode("ascii")
+    h = hmac_for(api_secret)
+    h.update(data)
+    return h.hexdigest()
+
+# 歷史查詢各時間窗的簽名（historical_query / line_bot / streamlit_app 共用）
+@lru_cache(maxsize=1024)
+def generate_historic_signature(api_key: str, api_secret: str, t: int, station_id: str, start_ts: int, end_ts: int) -> str:
+    """生成 Historic API 簽名"""
+    data = f"api-key{api_key}end-timestamp{end_ts}start-timestamp{start_ts}station-id{station_id}t{t}".encode("ascii")
+    h = hmac_for(api_secret)
+    h.update(data)
+    return h.hexdigest()
 
 def get_current_airlink_data(api_key: str, api_secret: str, station_id: str) -> Optional[Dict]:
-    """取得 AirLink 即時資料"""
+    """取得 AirLink 即時資料（5 分鐘快取）"""
+    return cached(_airlink_key(api_key, station_id), AIRLINK_CACHE_TTL, _fetch_current_airlink_data, api_key, api_secret, station_id)
+
+def _airlink_key(api_key: str, station_id: str) -> tuple:
+    return ("airlink", api_key, station_id)
+
+def _fetch_current_airlink_data(api_key: str, api_secret: str, station_id: str) -> Optional[Dict]:
+    """呼叫 AirLink Current API"""
     try:
         if not station_id:
             station_id = "167944"
         
-        t = int(time.time())
+        # 簽名與查詢參數使用同一個 t
+        t = int(time.time()) // SIGNATURE_WINDOW * SIGNATURE_WINDOW
         signature = generate_current_signature(api_key, api_secret, t, station_id)
         
         url = f"https://api.weatherlink.com/v2/current/{station_id}"
         params = {"api-key": api_key, "t": t, "api-signature": signature}
         
-        print(f"📡 AirLink API: {datetime.datetime.now(TW_TZ).strftime('%Y-%m-%d %H:%M:%S')}")
+        logger.debug("📡 AirLink API: station=%s t=%d", station_id, t)
         
-        response = requests.get(url, params=params, timeout=10)
+        response = get_session().get(url, params=params, timeout=10)
         
         if response.status_code == 200:
-            data = response.json()
+            data = orjson.loads(response.content)
             result = {}
-            sensors = data.get("sensors", [])
             
-            print(f"   找到 {len(sensors)} 個感應器")
+            logger.debug("   找到 %d 個感應器", len(data.get("sensors", ())))
             
-            for sensor in sensors:
-                lsid = sensor.get("lsid")
+            for station_name, sensor_data in iter_airlink_sensors(data):
+                latest = sensor_data[0]
                 
-                if lsid in AIRLINK_LSIDS:
-                    station_name = AIRLINK_LSIDS[lsid]
-                    sensor_data = sensor.get("data", [])
-                    
-                    if sensor_data:
-                        latest = sensor_data[0]
-                        
-                        # 優先使用 _last 欄位
-                        pm25 = latest.get("pm_2p5_last") or latest.get("pm_2p5")
-                        pm10 = latest.get("pm_10_last") or latest.get("pm_10")
-                        
-                        # 時間處理：只顯示時間，不加標籤
-                        data_ts = latest.get("ts")
-                        if data_ts:
-                            data_time = datetime.datetime.fromtimestamp(data_ts, tz=TW_TZ)
-                            time_label = data_time.strftime("%m/%d %H:%M")
-                        else:
-                            current_time = datetime.datetime.now(TW_TZ)
-                            time_label = current_time.strftime("%m/%d %H:%M")
-                        
-                        if pm25 is not None or pm10 is not None:
-                            result[station_name] = {
-                                "PM2.5": round(pm25, 1) if pm25 else None,
-                                "PM10": round(pm10, 1) if pm10 else None,
-                                "time": time_label
-                            }
-                            print(f"   ✅ {station_name}: PM2.5={pm25}")
+                # 優先使用 _last 欄位
+                pm25 = first_not_none(latest, CURRENT_PM25_FIELDS)
+                pm10 = first_not_none(latest, CURRENT_PM10_FIELDS)
+                
+                # 時間處理：只顯示時間，不加標籤
+                data_ts = latest.get("ts")
+                if data_ts:
+                    time_label = _format_ts(data_ts)
+                else:
+                    time_label = datetime.datetime.now(TW_TZ).strftime("%m/%d %H:%M")
+                
+                if pm25 is not None or pm10 is not None:
+                    result[station_name] = {
+                        "PM2.5": round1(pm25),
+                        "PM10": round1(pm10),
+                        "time": time_label
+                    }
+                    logger.debug("   ✅ %s: PM2.5=%s", station_name, pm25)
             
             if result:
-                print(f"✅ AirLink 成功: {len(result)} 個測站")
+                logger.info("✅ AirLink 成功: %d 個測站", len(result))
                 return result
         
-        print(f"⚠️ AirLink API 狀態: {response.status_code}")
+        logger.warning("⚠️ AirLink API 狀態: %s", response.status_code)
         return None
             
-    except Exception as e:
-        print(f"❌ AirLink 異常: {e}")
-        import traceback
-        traceback.print_exc()
+    except Exception:
+        logger.exception("❌ AirLink 異常")
         return None
 
 def clean_concentration(value) -> Optional[float]:
     """清理環保署資料"""
-    if not value:
+    if value is None:
         return None
     value_str = str(value).strip()
-    invalid_markers = ['#', '*', 'x', 'A', 'NR', 'ND', '', '-']
-    if value_str in invalid_markers or any(m in value_str for m in invalid_markers if m):
+    if value_str in _INVALID_EXACT:
+        return None
+    # 單字元標記用 frozenset 比對（逐筆呼叫時比 regex 快），兩字元標記另外檢查
+    if not _INVALID_CHARS.isdisjoint(value_str) or "NR" in value_str or "ND" in value_str:
         return None
     try:
         numeric_value = float(value_str)
-        return numeric_value if 0 <= numeric_value <= 1000 else None
-    except:
+    except (ValueError, TypeError):
         return None
+    return numeric_value if 0 <= numeric_value <= 1000 else None
 
 def get_current_moenv_data(api_token: str) -> Optional[Dict]:
-    """取得環保署資料"""
+    """取得環保署資料（10 分鐘快取）"""
+    return cached(_moenv_key(api_token), MOENV_CACHE_TTL, _fetch_current_moenv_data, api_token)
+
+def _moenv_key(api_token: str) -> tuple:
+    return ("moenv", api_token)
+
+def _fetch_current_moenv_data(api_token: str) -> Optional[Dict]:
+    """呼叫環保署即時 API"""
     try:
         url = "https://data.moenv.gov.tw/api/v2/aqx_p_432"
-        params = {"api_key": api_token, "limit": 100, "format": "json"}
-        print(f"📡 環保署 API...")
-        response = requests.get(url, params=params, timeout=10, verify=False)
+        params = {"api_key": api_token, "limit": 100, "format": "json", "filters": MOENV_SITE_FILTER}
+        logger.debug("📡 環保署 API...")
+        response = get_session().get(url, params=params, timeout=10, verify=MOENV_VERIFY)
         
         if response.status_code == 200:
-            data = response.json()
+            data = orjson.loads(response.content)
             records = data.get("records", [])
             result = {}
-            target_stations = ["仁武", "楠梓"]
             
             for record in records:
                 site_name = record.get("sitename", "")
-                if site_name in target_stations:
-                    pm25 = clean_concentration(record.get("pm2.5", ""))
-                    pm10 = clean_concentration(record.get("pm10", ""))
+                if site_name not in MOENV_TARGETS:
+                    continue
+                
+                pm25 = clean_concentration(record.get("pm2.5", ""))
+                pm10 = clean_concentration(record.get("pm10", ""))
+                
+                if pm25 is not None or pm10 is not None:
+                    publish_time = record.get("publishtime", "")
+                    
+                    # 只顯示時間，不加標籤
+                    time_str = _format_publish_time(publish_time) if publish_time else ""
                     
-                    if pm25 is not None or pm10 is not None:
-                        publish_time = record.get("publishtime", "")
-                        
-                        # 只顯示時間，不加標籤
-                        if publish_time:
-                            try:
-                                dt = datetime.datetime.strptime(publish_time, "%Y-%m-%d %H:%M:%S")
-                                time_str = dt.strftime("%m/%d %H:%M")
-                            except:
-                                time_str = publish_time
-                        else:
-                            time_str = ""
-                        
-                        result[site_name] = {
-                            "PM2.5": round(pm25, 1) if pm25 else None,
-                            "PM10": round(pm10, 1) if pm10 else None,
-                            "time": time_str
-                        }
+                    result[site_name] = {
+                        "PM2.5": round1(pm25),
+                        "PM10": round1(pm10),
+                        "time": time_str
+                    }
+                    # 兩個目標測站都找到就不必再掃描
+                    if len(result) == len(MOENV_TARGETS):
+                        break
             
-            print(f"✅ 環保署: {len(result)} 個測站")
+            logger.info("✅ 環保署: %d 個測站", len(result))
             return result
         return None
     except Exception as e:
-        print(f"❌ 環保署錯誤: {e}")
+        logger.error("❌ 環保署錯誤: %s", e)
         return None
 
+# 並行查詢時每個來源的等待上限（秒）
+FETCH_TIMEOUT = 12
+
+# 即時查詢的執行緒池，每個來源各自一個（每次查詢不再建立/關閉執行緒）；逾時中的請求留在池內跑完，不阻塞呼叫端
+# 來源分開：某一來源卡住時，等在其 key 鎖上的 worker 不會讓另一來源排隊
+_FETCH_POOLS = {
+    "AirLink": ThreadPoolExecutor(max_workers=2, thread_name_prefix="fetch-airlink"),
+    "環保署": ThreadPoolExecutor(max_workers=2, thread_name_prefix="fetch-moenv"),
+}
+
+def fetch_all(api_key: str, api_secret: str, station_id: str, moenv_token: str,
+              timeout: float = FETCH_TIMEOUT) -> Dict:
+    """並行取得 AirLink 與環保署即時資料並合併；任一來源失敗或逾時（共用 timeout 秒）仍回傳另一來源"""
+    jobs = {"AirLink": (_airlink_key(api_key, station_id), get_current_airlink_data, (api_key, api_secret, station_id))}
+    if moenv_token:
+        jobs["環保署"] = (_moenv_key(moenv_token), get_current_moenv_data, (moenv_token,))
+    
+    # 快取命中直接在呼叫端取用，只有未命中的來源才交給執行緒池
+    results = {}
+    for source, (key, fn, args) in jobs.items():
+        data = cache_peek(key)
+        results[source] = data if data is not None else _FETCH_POOLS[source].submit(fn, *args)
+    
+    all_data = {}
+    deadline = time.monotonic() + timeout
+    for source, data in results.items():
+        if isinstance(data, Future):
+            try:
+                data = data.result(timeout=max(0, deadline - time.monotonic()))
+            except Exception as e:
+                logger.warning("⚠️ %s 即時資料失敗: %s %s", source, type(e).__name__, e)
+                continue
+        if data:
+            all_data.update(data)
+    return all_data
+
+# PM2.5 空品等級：(上限 μg/m³, 等級, 顏色)，超過最後一級為「非常不良」
+AQI_BREAKS = [
+    (15, "😊 優良", "#00E400"),
+    (30, "🙂 良好", "#FFFF00"),
+    (50, "😐 普通", "#FF7E00"),
+    (100, "😷 不良", "#FF0000"),
+]
+_AQI_WORST = ("☠️ 非常不良", "#7E0023")
+_AQI_NO_DATA = ("❓ 無資料", "")
+# 二分搜尋用：上限與對應等級（多一個「非常不良」接在最後）
+_AQI_KEYS = [limit for limit, _, _ in AQI_BREAKS]
+_AQI_VALS = [(level, color) for _, level, color in AQI_BREAKS] + [_AQI_WORST]
+
 def get_aqi_level(pm25_value: Optional[float]) -> Tuple[str, str]:
-    """判斷空品等級"""
+    """判斷空品等級（數值已由 clean_concentration / round 處理過）"""
     if pm25_value is None:
-        return "❓ 無資料", ""
-    try:
-        pm25 = float(pm25_value)
-        if pm25 <= 15:
-            return "😊 優良", "#00E400"
-        elif pm25 <= 30:
-            return "🙂 良好", "#FFFF00"
-        elif pm25 <= 50:
-            return "😐 普通", "#FF7E00"
-        elif pm25 <= 100:
-            return "😷 不良", "#FF0000"
-        else:
-            return "☠️ 非常不良", "#7E0023"
-    except:
-        return "❓ 無資料", ""
+        return _AQI_NO_DATA
+    # bisect_left：剛好等於上限時仍屬該級
+    return _AQI_VALS[bisect_left(_AQI_KEYS, pm25_value)]
+
+# 即時訊息範本：開頭、每個測站區塊、固定結尾
+_DIVIDER = "━━━━━━━━━━━━━━━\n"
+_STATION_ORDER = ("仁武", "楠梓", "南區上", "南區下")
+_MESSAGE_HEADER_TMPL = "🕐 查詢時間: {time}\n\n📊 最新空氣品質\n" + _DIVIDER + "\n"
+_STATION_TMPL = "📍 {name}\n  PM2.5: {pm25}\n  PM10:  {pm10}\n{time}\n"
+_MESSAGE_FOOTER = (
+    _DIVIDER + "📌 法規標準（24小時平均值）\n• PM2.5 ≤ 30 μg/m³\n• PM10  ≤ 75 μg/m³\n\n"
+    "ℹ️ 資料來源：AirLink、環保署\n🔄 更新頻率：5-15 分鐘\n\n💡 輸入「選單」查看更多功能"
+)
+_NO_DATA_MSG = "❌ 無法取得資料\n\n請稍後再試或點擊「開啟查詢系統」"
 
-def format_air_quality_message(data: Dict) -> str:
-    """格式化訊息"""
+def format_air_quality_message(data: Dict, now: Optional[datetime.datetime] = None) -> str:
+    """格式化訊息（now 未指定時取目前台灣時間）"""
     if not data:
-        return "❌ 無法取得資料\n\n請稍後再試或點擊「開啟查詢系統」"
+        return _NO_DATA_MSG
     
-    current_time = datetime.datetime.now(TW_TZ).strftime("%m/%d %H:%M")
-    message = f"🕐 查詢時間: {current_time}\n\n📊 最新空氣品質\n━━━━━━━━━━━━━━━\n\n"
+    if now is None:
+        now = datetime.datetime.now(TW_TZ)
+    parts = [_MESSAGE_HEADER_TMPL.format(time=now.strftime("%m/%d %H:%M"))]
     
-    station_order = ["仁武", "楠梓", "南區上", "南區下"]
-    
-    for station in station_order:
-        if station in data:
-            values = data[station]
-            pm25 = values.get("PM2.5")
-            pm10 = values.get("PM10")
-            time_str = values.get("time", "")
+    for station in _STATION_ORDER:
+        values = data.get(station)
+        if values is None:
+            continue
+        
+        pm25 = values.get("PM2.5")
+        pm10 = values.get("PM10")
+        time_str = values.get("time", "")
+        
+        if pm25 is not None:
             level, _ = get_aqi_level(pm25)
-            
-            message += f"📍 {station}\n"
-            if pm25 is not None:
-                exceed = " ⚠️" if pm25 > 30 else ""
-                message += f"  PM2.5: {pm25} μg/m³{exceed}  {level}\n"
-            else:
-                message += f"  PM2.5: -- μg/m³\n"
-            
-            if pm10 is not None:
-                exceed = " ⚠️" if pm10 > 75 else ""
-                message += f"  PM10:  {pm10} μg/m³{exceed}\n"
-            else:
-                message += f"  PM10:  -- μg/m³\n"
-            
-            if time_str:
-                message += f"  📝 資料時間: {time_str}\n"
-            message += "\n"
+            pm25_text = f"{pm25} μg/m³{' ⚠️' if pm25 > 30 else ''}  {level}"
+        else:
+            pm25_text = "-- μg/m³"
+        
+        if pm10 is not None:
+            pm10_text = f"{pm10} μg/m³{' ⚠️' if pm10 > 75 else ''}"
+        else:
+            pm10_text = "-- μg/m³"
+        
+        parts.append(_STATION_TMPL.format(
+            name=station,
+            pm25=pm25_text,
+            pm10=pm10_text,
+            time=f"  📝 資料時間: {time_str}\n" if time_str else ""
+        ))
     
-    message += "━━━━━━━━━━━━━━━\n📌 法規標準（24小時平均值）\n• PM2.5 ≤ 30 μg/m³\n• PM10  ≤ 75 μg/m³\n\n"
-    message += "ℹ️ 資料來源：AirLink、環保署\n🔄 更新頻率：5-15 分鐘\n\n💡 輸入「選單」查看更多功能"
+    parts.append(_MESSAGE_FOOTER)
+    return "".join(parts)
+
+# 格式化後的即時訊息以分鐘為單位重用（訊息時間只顯示到分鐘）
+# 獨立存放、每個測站只保留最近一分鐘的訊息，不占用資料快取的 LRU 名額
+_MESSAGE_CACHE: Dict[tuple, Tuple[datetime.datetime, str]] = {}
+_MESSAGE_CACHE_LOCK = threading.Lock()
+
+def current_air_quality_message(api_key: str, api_secret: str, station_id: str, moenv_token: str,
+                                timeout: float = FETCH_TIMEOUT) -> str:
+    """取得並格式化即時空品；同一分鐘內的查詢直接回傳相同訊息（無資料時不快取）"""
+    now = datetime.datetime.now(TW_TZ).replace(second=0, microsecond=0)
+    key = (api_key, station_id)
+    with _MESSAGE_CACHE_LOCK:
+        entry = _MESSAGE_CACHE.get(key)
+    if entry and entry[0] == now:
+        return entry[1]
+    
+    data = fetch_all(api_key, api_secret, station_id, moenv_token, timeout)
+    if not data:
+        return _NO_DATA_MSG
+    message = format_air_quality_message(data, now)
+    with _MESSAGE_CACHE_LOCK:
+        _MESSAGE_CACHE[key] = (now, message)
     return message
 
-def format_station_info() -> str:
-    """測站資訊"""
-    return """📍 監測站點資訊
+_STATION_INFO_MSG = """📍 監測站點資訊
 ━━━━━━━━━━━━━━━
 
 【AirLink 測站】
@@ -249,8 +536,13 @@ def format_station_info() -> str:
 🎯 涵蓋範圍：高雄市南區、仁武、楠梓
 💡 輸入「今日」查看即時空品"""
 
+def format_station_info() -> str:
+    """測站資訊"""
+    return _STATION_INFO_MSG
+
 if __name__ == "__main__":
     import sys
+    logging.basicConfig(level=logging.DEBUG, format="%(message)s")
     print("🧪 API 測試（簡潔時間版）")
     api_key = os.getenv('API_KEY', '')
     api_secret = os.getenv('API_SECRET', '')
@@ -264,18 +556,7 @@ if __name__ == "__main__":
     print(f"\nStation ID: {station_id or '167944'}")
     print(f"目標 LSID: {list(AIRLINK_LSIDS.keys())}\n")
     
-    airlink_data = get_current_airlink_data(api_key, api_secret, station_id)
-    
-    if moenv_token:
-        moenv_data = get_current_moenv_data(moenv_token)
-    else:
-        moenv_data = None
-    
-    all_data = {}
-    if airlink_data:
-        all_data.update(airlink_data)
-    if moenv_data:
-        all_data.update(moenv_data)
+    all_data = fetch_all(api_key, api_secret, station_id, moenv_token)
     
     if all_data:
         print("\n" + "=" * 70)
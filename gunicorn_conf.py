@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn 設定（Procfile: gunicorn -c gunicorn_conf.py line_bot:app）
+webhook 多半在等待外部 API，使用 gthread 讓同一個 worker 同時處理多個請求
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '10000')}"
+worker_class = "gthread"
+
+# 未設定 REDIS_URL 時使用者狀態存在各 worker 記憶體內，多個 worker 會讓「歷史查詢」狀態遺失
+workers = int(os.getenv('WEB_CONCURRENCY', '1'))
+# 舊設定名稱 GUNICORN_THREADS 仍可使用
+threads = int(os.getenv('WEB_THREADS') or os.getenv('GUNICORN_THREADS') or '8')
+
+# 需大於即時查詢的等待上限（FETCH_TIMEOUT）
+timeout = 45
+keepalive = 5
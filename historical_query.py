@@ -5,41 +5,42 @@ historical_query.py - 歷史資料查詢模組
 提供日期範圍查詢、統計摘要、趨勢圖等功能
 """
 
-import requests
-import hmac
-import hashlib
 import time
 import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Optional, Tuple
-from zoneinfo import ZoneInfo
+import numpy as np
 import pandas as pd
 
-# 台灣時區
-TW_TZ = ZoneInfo("Asia/Taipei")
+# orjson 解析較快；未安裝時退回標準函式庫（json.loads 同樣接受 bytes）
+try:
+    import orjson
+except ImportError:
+    import json as orjson
 
-# LSID 對應
-AIRLINK_LSIDS = {
-    652269: "南區上",
-    655484: "南區下"
-}
+from air_quality_api import (
+    INVALID_MARKER_RE, MOENV_VERIFY, SIGNATURE_WINDOW, TW_TZ, HistoricColumns, cached,
+    generate_historic_signature, get_session, historic_cache_ttl, historic_columns
+)
 
-def generate_signature(api_key: str, api_secret: str, t: int, station_id: str, start_ts: int, end_ts: int) -> str:
-    """生成 Historic API 簽名"""
-    parts = [
-        "api-key", api_key,
-        "end-timestamp", str(end_ts),
-        "start-timestamp", str(start_ts),
-        "station-id", str(station_id),
-        "t", str(t)
-    ]
-    data = "".join(parts)
-    return hmac.new(api_secret.encode(), data.encode(), hashlib.sha256).hexdigest()
+# 台灣無日光節約時間，時間戳記固定加 8 小時
+_TW_OFFSET = np.timedelta64(8, "h")
+
+# 訊息分隔線
+_DIVIDER = "━━━━━━━━━━━━━━━\n"
+
+def fetch_airlink_historical(api_key: str, api_secret: str, station_id: str, start_ts: int, end_ts: int) -> Optional[HistoricColumns]:
+    """取得 AirLink 歷史資料欄位（已結束的日期快取一天，含今天者快取 5 分鐘）"""
+    key = ("airlink-historic", api_key, station_id, start_ts, end_ts)
+    return cached(key, historic_cache_ttl(end_ts), _fetch_airlink_historical, api_key, api_secret, station_id, start_ts, end_ts)
 
-def fetch_airlink_historical(api_key: str, api_secret: str, station_id: str, start_ts: int, end_ts: int) -> Optional[Dict]:
-    """取得 AirLink 歷史資料"""
+def _fetch_airlink_historical(api_key: str, api_secret: str, station_id: str, start_ts: int, end_ts: int) -> Optional[HistoricColumns]:
+    """呼叫 AirLink Historic API（僅在快取未命中時呼叫，於此控制請求間隔）"""
+    _airlink_rate_limit()
     try:
-        t = int(time.time())
-        signature = generate_signature(api_key, api_secret, t, station_id, start_ts, end_ts)
+        t = int(time.time()) // SIGNATURE_WINDOW * SIGNATURE_WINDOW
+        signature = generate_historic_signature(api_key, api_secret, t, station_id, start_ts, end_ts)
         
         url = f"https://api.weatherlink.com/v2/historic/{station_id}"
         params = {
@@ -50,10 +51,10 @@ def fetch_airlink_historical(api_key: str, api_secret: str, station_id: str, sta
             "api-signature": signature
         }
         
-        response = requests.get(url, params=params, timeout=30)
+        response = get_session().get(url, params=params, timeout=30)
         
         if response.status_code == 200:
-            return response.json()
+            return historic_columns(orjson.loads(response.content))
         else:
             print(f"❌ Historic API 錯誤: {response.status_code}")
             return None
@@ -62,7 +63,27 @@ def fetch_airlink_historical(api_key: str, api_secret: str, station_id: str, sta
         print(f"❌ Historic API 異常: {e}")
         return None
 
-def fetch_airlink_data_range(api_key: str, api_secret: str, station_id: str, start_date: datetime.date, end_date: datetime.date) -> List[Dict]:
+def _make_rate_limiter(min_interval: float):
+    """建立請求間隔控制：依序分配請求時間點，必要時等待到輪到自己"""
+    lock = threading.Lock()
+    next_request_at = [0.0]
+    
+    def wait():
+        with lock:
+            now = time.monotonic()
+            delay = next_request_at[0] - now
+            next_request_at[0] = max(now, next_request_at[0]) + min_interval
+        if delay > 0:
+            time.sleep(delay)
+    
+    return wait
+
+# AirLink 逐日查詢改為並行：同時最多 4 個請求，請求間隔至少 0.2 秒（WeatherLink 每秒上限 10 次）
+AIRLINK_RANGE_WORKERS = 4
+AIRLINK_MIN_INTERVAL = 0.2
+_airlink_rate_limit = _make_rate_limiter(AIRLINK_MIN_INTERVAL)
+
+def fetch_airlink_data_range(api_key: str, api_secret: str, station_id: str, start_date: datetime.date, end_date: datetime.date) -> pd.DataFrame:
     """
     取得指定日期範圍的 AirLink 資料
     
@@ -74,189 +95,210 @@ def fetch_airlink_data_range(api_key: str, api_secret: str, station_id: str, sta
         end_date: 結束日期
     
     Returns:
-        List of records with device, date, datetime, PM2.5, PM10
+        DataFrame with columns: device, date, datetime, PM2.5, PM10
     """
-    all_records = []
+    # 以欄為單位累積（每筆一個 dict 的記憶體與建表成本較高）
+    devices, ts_col, pm25_col, pm10_col = [], [], [], []
     
     start_dt = datetime.datetime.combine(start_date, datetime.time.min, tzinfo=TW_TZ)
     end_dt = datetime.datetime.combine(end_date, datetime.time.max, tzinfo=TW_TZ)
     
-    current_dt = start_dt
-    
     print(f"📡 查詢 AirLink 資料: {start_date} ~ {end_date}")
     
-    # 逐日查詢（避免單次查詢太多資料）
-    while current_dt <= end_dt:
+    # 逐日切分時間窗（避免單次查詢太多資料）
+    windows = []
+    current_dt = start_dt
+    while current_dt < end_dt:
         next_dt = min(current_dt + datetime.timedelta(days=1), end_dt)
-        
-        start_ts = int(current_dt.timestamp())
-        end_ts = int(next_dt.timestamp())
-        
-        data = fetch_airlink_historical(api_key, api_secret, station_id, start_ts, end_ts)
-        
-        if data:
-            sensors = data.get("sensors", [])
-            
-            for sensor in sensors:
-                lsid = sensor.get("lsid")
-                
-                if lsid in AIRLINK_LSIDS:
-                    station_name = AIRLINK_LSIDS[lsid]
-                    sensor_data = sensor.get("data", [])
-                    
-                    for record in sensor_data:
-                        ts = record.get("ts")
-                        if ts:
-                            # 轉換為台灣時間
-                            timestamp = datetime.datetime.fromtimestamp(ts, tz=TW_TZ)
-                            date_str = timestamp.strftime("%Y/%m/%d")
-                            datetime_str = timestamp.strftime("%Y/%m/%d %H:%M")
-                            
-                            # 取得 PM 值
-                            pm25 = record.get("pm_2p5_avg") or record.get("pm_2p5") or record.get("pm_2p5_last")
-                            pm10 = record.get("pm_10_avg") or record.get("pm_10") or record.get("pm_10_last")
-                            
-                            if pm25 is not None or pm10 is not None:
-                                all_records.append({
-                                    "device": station_name,
-                                    "date": date_str,
-                                    "datetime": datetime_str,
-                                    "PM2.5": round(pm25, 1) if pm25 else None,
-                                    "PM10": round(pm10, 1) if pm10 else None
-                                })
-        
+        windows.append((int(current_dt.timestamp()), int(next_dt.timestamp())))
         current_dt = next_dt
-        time.sleep(1)  # 避免 API 限速
     
-    print(f"✅ 取得 {len(all_records)} 筆 AirLink 資料")
-    return all_records
+    def fetch_window(window):
+        return fetch_airlink_historical(api_key, api_secret, station_id, *window)
+    
+    # 並行查詢，map 依時間窗順序回傳結果
+    with ThreadPoolExecutor(max_workers=AIRLINK_RANGE_WORKERS) as executor:
+        results = list(executor.map(fetch_window, windows))
+    
+    for data in results:
+        if data:
+            for station_name, (ts, pm25, pm10) in data.items():
+                ts_col.extend(ts)
+                pm25_col.extend(pm25)
+                pm10_col.extend(pm10)
+                devices.extend([station_name] * len(ts))
+    
+    if not ts_col:
+        print("✅ 取得 0 筆 AirLink 資料")
+        return pd.DataFrame(columns=["device", "date", "datetime", "PM2.5", "PM10"])
+    
+    # 整批轉換為台灣時間字串："YYYY-MM-DDTHH:MM" → "YYYY/MM/DD HH:MM"，日期取前 10 字
+    local = np.array(ts_col, dtype="datetime64[s]") + _TW_OFFSET
+    datetime_col = np.char.replace(np.char.replace(np.datetime_as_string(local, unit="m"), "-", "/"), "T", " ")
+    airlink_df = pd.DataFrame({
+        "device": pd.Categorical(devices),
+        "date": datetime_col.astype("U10"),
+        "datetime": datetime_col,
+        "PM2.5": np.array(pm25_col, dtype="float64"),
+        "PM10": np.array(pm10_col, dtype="float64"),
+    })
+    
+    print(f"✅ 取得 {len(airlink_df)} 筆 AirLink 資料")
+    return airlink_df
 
-def clean_concentration(value) -> Optional[float]:
-    """清理環保署資料"""
-    if not value:
-        return None
-    value_str = str(value).strip()
-    invalid_markers = ['#', '*', 'x', 'A', 'NR', 'ND', '', '-']
-    if value_str in invalid_markers or any(m in value_str for m in invalid_markers if m):
-        return None
-    try:
-        numeric_value = float(value_str)
-        return numeric_value if 0 <= numeric_value <= 1000 else None
-    except:
-        return None
+def clean_concentration_series(values: pd.Series) -> pd.Series:
+    """向量化版 clean_concentration：無效標記、無法轉換或超出 0-1000 者為 NaN"""
+    text = values.astype(str).str.strip()
+    invalid = text.str.contains(INVALID_MARKER_RE, na=True)
+    numeric = pd.to_numeric(text.where(~invalid), errors='coerce')
+    return numeric.where((numeric >= 0) & (numeric <= 1000))
+
+# 環保署查詢切成 7 天一段並行取得（每段通常一頁就結束），請求間隔至少 0.25 秒
+MOENV_WINDOW_DAYS = 7
+MOENV_RANGE_WORKERS = 4
+MOENV_MIN_INTERVAL = 0.25
+MOENV_PAGE_LIMIT = 1000
+_moenv_rate_limit = _make_rate_limiter(MOENV_MIN_INTERVAL)
+
+def _fetch_moenv_window(api_token: str, dataset_id: str, station_name: str,
+                        window_start: datetime.date, window_end: datetime.date) -> List[Dict]:
+    """取得單一測站、單一時間段的環保署資料（含分頁）"""
+    records_out = []
+    offset = 0
+    # GR 不含下界：以前一天 23:59:59 為界，時間段第一天 00:00 的資料才不會遺漏
+    date_filter = (f"monitordate,GR,{window_start - datetime.timedelta(days=1):%Y-%m-%d} 23:59:59|"
+                   f"monitordate,LE,{window_end:%Y-%m-%d} 23:59:59|itemid,EQ,33,4")
+    url = f"https://data.moenv.gov.tw/api/v2/{dataset_id}"
+    
+    while True:
+        params = {
+            "api_key": api_token,
+            "format": "json",
+            "offset": offset,
+            "limit": MOENV_PAGE_LIMIT,
+            "filters": date_filter
+        }
+        
+        try:
+            _moenv_rate_limit()
+            response = get_session().get(url, params=params, timeout=30, verify=MOENV_VERIFY)
+            response.raise_for_status()
+            data = orjson.loads(response.content)
+            records = data.get("records", [])
+            
+            if not records:
+                break
+            
+            for record in records:
+                record['station_name'] = station_name
+            
+            records_out.extend(records)
+            
+            if len(records) < MOENV_PAGE_LIMIT:
+                break
+            
+            offset += MOENV_PAGE_LIMIT
+            
+        except Exception as e:
+            print(f"❌ 環保署 API 錯誤: {e}")
+            break
+    
+    return records_out
 
 def fetch_moenv_data_range(api_token: str, start_date: datetime.date, end_date: datetime.date) -> List[Dict]:
     """
     取得指定日期範圍的環保署資料
     """
-    moenv_records = []
     moenv_stations = {"AQX_P_237": "仁武", "AQX_P_241": "楠梓"}
     
-    start_date_str = start_date.strftime("%Y-%m-%d")
-    end_date_str = end_date.strftime("%Y-%m-%d")
-    
     print(f"📡 查詢環保署資料: {start_date} ~ {end_date}")
     
-    for dataset_id, station_name in moenv_stations.items():
-        offset = 0
-        limit = 1000
-        date_filter = f"monitordate,GR,{start_date_str} 00:00:00|monitordate,LE,{end_date_str} 23:59:59|itemid,EQ,33,4"
-        
-        while True:
-            url = f"https://data.moenv.gov.tw/api/v2/{dataset_id}"
-            params = {
-                "api_key": api_token,
-                "format": "json",
-                "offset": offset,
-                "limit": limit,
-                "filters": date_filter
-            }
-            
-            try:
-                response = requests.get(url, params=params, timeout=30, verify=False)
-                response.raise_for_status()
-                data = response.json()
-                records = data.get("records", [])
-                
-                if not records:
-                    break
-                
-                for record in records:
-                    record['station_name'] = station_name
-                
-                moenv_records.extend(records)
-                
-                if len(records) < limit:
-                    break
-                
-                offset += limit
-                time.sleep(0.5)
-                
-            except Exception as e:
-                print(f"❌ 環保署 API 錯誤: {e}")
-                break
+    # 依測站、時間段排列，map 依此順序回傳
+    windows = []
+    window_start = start_date
+    while window_start <= end_date:
+        window_end = min(window_start + datetime.timedelta(days=MOENV_WINDOW_DAYS - 1), end_date)
+        windows.append((window_start, window_end))
+        window_start = window_end + datetime.timedelta(days=1)
+    tasks = [(dataset_id, station_name, ws, we)
+             for dataset_id, station_name in moenv_stations.items()
+             for ws, we in windows]
+    
+    with ThreadPoolExecutor(max_workers=MOENV_RANGE_WORKERS) as executor:
+        results = executor.map(lambda task: _fetch_moenv_window(api_token, *task), tasks)
+        moenv_records = [record for records in results for record in records]
     
     print(f"✅ 取得 {len(moenv_records)} 筆環保署資料")
     return moenv_records
 
-def calculate_daily_averages(airlink_records: List[Dict], moenv_records: List[Dict]) -> pd.DataFrame:
+# 每日平均只用到的欄位與型別
+_AIRLINK_COLUMNS = ["device", "date", "PM2.5", "PM10"]
+_AIRLINK_DTYPES = {"device": "category", "date": str, "PM2.5": "float64", "PM10": "float64"}
+_MOENV_COLUMNS = ["station_name", "monitordate", "itemid", "concentration"]
+
+def calculate_daily_averages(airlink_records, moenv_records: List[Dict]) -> pd.DataFrame:
     """
     計算每日平均值
     
+    Args:
+        airlink_records: fetch_airlink_data_range 回傳的 DataFrame（亦接受 list of dict）
+        moenv_records: fetch_moenv_data_range 回傳的紀錄
+    
     Returns:
         DataFrame with columns: device, date, PM2.5, PM10
     """
-    # 處理 AirLink 資料
-    airlink_df = pd.DataFrame(airlink_records)
+    # 處理 AirLink 資料（只取需要的欄位並直接指定型別，省去逐欄推斷）
+    if isinstance(airlink_records, pd.DataFrame):
+        airlink_df = airlink_records[_AIRLINK_COLUMNS]
+    else:
+        airlink_df = pd.DataFrame.from_records(airlink_records, columns=_AIRLINK_COLUMNS)
     if not airlink_df.empty:
-        airlink_daily = airlink_df.groupby(["device", "date"]).agg({
+        # 分組欄位轉為 category，groupby 以整數代碼分組
+        airlink_df = airlink_df.astype(_AIRLINK_DTYPES)
+        airlink_daily = airlink_df.groupby(["device", "date"], observed=True, sort=False).agg({
             "PM2.5": "mean",
             "PM10": "mean"
         }).reset_index()
+        airlink_daily["device"] = airlink_daily["device"].astype(str)
         airlink_daily["PM2.5"] = airlink_daily["PM2.5"].round(0).astype(int)
         airlink_daily["PM10"] = airlink_daily["PM10"].round(0).astype(int)
     else:
         airlink_daily = pd.DataFrame()
     
     # 處理環保署資料
-    moenv_df = pd.DataFrame(moenv_records)
+    moenv_df = pd.DataFrame.from_records(moenv_records, columns=_MOENV_COLUMNS)
     if not moenv_df.empty:
-        moenv_df['concentration'] = moenv_df['concentration'].apply(clean_concentration)
+        moenv_df['concentration'] = clean_concentration_series(moenv_df['concentration'])
         moenv_df = moenv_df[moenv_df['concentration'].notna()].copy()
-        moenv_df['concentration'] = pd.to_numeric(moenv_df['concentration'], errors='coerce')
         moenv_df['itemid'] = moenv_df['itemid'].astype(str)
-        moenv_df['date'] = pd.to_datetime(moenv_df['monitordate']).dt.date
-        moenv_df['date'] = moenv_df['date'].astype(str).str.replace('-', '/')
+        # monitordate 為 "YYYY-MM-DD HH:MM:SS"，直接取日期部分
+        moenv_df['date'] = moenv_df['monitordate'].astype(str).str.slice(0, 10).str.replace('-', '/', regex=False)
         moenv_df = moenv_df[moenv_df['itemid'].isin(['33', '4'])].copy()
-        moenv_df['pollutant'] = moenv_df['itemid'].map({'33': 'PM2.5', '4': 'PM10'})
+        moenv_df['pollutant'] = moenv_df['itemid'].map({'33': 'PM2.5', '4': 'PM10'}).astype('category')
+        moenv_df['station_name'] = moenv_df['station_name'].astype('category')
         
-        moenv_daily = moenv_df.groupby(['station_name', 'date', 'pollutant']).agg({
+        moenv_daily = moenv_df.groupby(['station_name', 'date', 'pollutant'], observed=True, sort=False).agg({
             'concentration': 'mean'
         }).reset_index()
         
         moenv_daily_wide = moenv_daily.pivot_table(
             index=['station_name', 'date'],
             columns='pollutant',
-            values='concentration'
+            values='concentration',
+            observed=True
         ).reset_index()
+        moenv_daily_wide.columns = moenv_daily_wide.columns.astype(str)
         
         moenv_daily_wide['PM2.5'] = moenv_daily_wide['PM2.5'].round(0).astype(int)
         moenv_daily_wide['PM10'] = moenv_daily_wide['PM10'].round(0).astype(int)
         moenv_daily_wide.rename(columns={'station_name': 'device'}, inplace=True)
+        moenv_daily_wide['device'] = moenv_daily_wide['device'].astype(str)
     else:
         moenv_daily_wide = pd.DataFrame()
     
-    # 合併資料
-    if not airlink_daily.empty and not moenv_daily_wide.empty:
-        all_daily = pd.concat([airlink_daily, moenv_daily_wide], ignore_index=True)
-    elif not airlink_daily.empty:
-        all_daily = airlink_daily
-    elif not moenv_daily_wide.empty:
-        all_daily = moenv_daily_wide
-    else:
-        all_daily = pd.DataFrame()
-    
-    return all_daily
+    # 合併資料（兩者欄位相同，直接串接非空的部分）
+    frames = [df for df in (airlink_daily, moenv_daily_wide) if not df.empty]
+    return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
 
 def format_daily_table_message(all_daily: pd.DataFrame, start_date: datetime.date, end_date: datetime.date) -> str:
     """
@@ -268,51 +310,42 @@ def format_daily_table_message(all_daily: pd.DataFrame, start_date: datetime.dat
     station_order = ["仁武", "楠梓", "南區上", "南區下"]
     available_stations = [s for s in station_order if s in all_daily['device'].unique()]
     
-    # 建立 pivot table
-    pivot_pm25 = all_daily.pivot(index='date', columns='device', values='PM2.5')
-    pivot_pm10 = all_daily.pivot(index='date', columns='device', values='PM10')
-    
-    pivot_pm25 = pivot_pm25[[s for s in available_stations if s in pivot_pm25.columns]]
-    pivot_pm10 = pivot_pm10[[s for s in available_stations if s in pivot_pm10.columns]]
+    # 建立 pivot table：一次展開 PM2.5 與 PM10，欄位依測站排成 (PM2.5, PM10) 一組
+    wide = all_daily.pivot(index='date', columns='device', values=['PM2.5', 'PM10'])
+    columns = pd.MultiIndex.from_tuples([(p, s) for s in available_stations for p in ('PM2.5', 'PM10')])
+    values = wide.reindex(columns=columns).to_numpy()
     
     # 轉換為民國年
-    dates_roc = []
-    for date_str in pivot_pm25.index:
-        parts = date_str.split('/')
-        year_roc = int(parts[0]) - 1911
-        month = int(parts[1])
-        day = int(parts[2])
-        dates_roc.append(f"{year_roc}/{month}/{day}")
+    dates = pd.to_datetime(wide.index, format='%Y/%m/%d')
+    dates_roc = [f"{y}/{m}/{d}" for y, m, d in zip(dates.year - 1911, dates.month, dates.day)]
     
     # 格式化訊息
-    message = f"📅 查詢期間: {start_date.strftime('%Y/%m/%d')} ~ {end_date.strftime('%Y/%m/%d')}\n\n"
-    message += "📊 每日平均值\n"
-    message += "━━━━━━━━━━━━━━━\n\n"
-    
-    # 表頭
-    header = "日期".ljust(10)
-    for station in available_stations:
-        header += f"{station}".ljust(12)
-    message += header + "\n"
-    message += "     " + " PM2.5 PM10  " * len(available_stations) + "\n"
-    message += "─" * (10 + 12 * len(available_stations)) + "\n"
+    parts = [
+        f"📅 查詢期間: {start_date.strftime('%Y/%m/%d')} ~ {end_date.strftime('%Y/%m/%d')}\n\n",
+        "📊 每日平均值\n",
+        _DIVIDER,
+        "\n",
+        # 表頭
+        "日期".ljust(10),
+    ]
+    parts.extend(f"{station}".ljust(12) for station in available_stations)
+    parts.append("\n")
+    parts.append("     " + " PM2.5 PM10  " * len(available_stations) + "\n")
+    parts.append("─" * (10 + 12 * len(available_stations)) + "\n")
     
     # 資料行
-    for i, date_roc in enumerate(dates_roc):
-        row = date_roc.ljust(10)
+    for date_roc, row in zip(dates_roc, values):
+        parts.append(date_roc.ljust(10))
         
-        for station in available_stations:
-            pm25 = pivot_pm25.loc[pivot_pm25.index[i], station] if station in pivot_pm25.columns else None
-            pm10 = pivot_pm10.loc[pivot_pm10.index[i], station] if station in pivot_pm10.columns else None
-            
+        for pm25, pm10 in zip(row[0::2], row[1::2]):
             pm25_str = str(int(pm25)).rjust(3) if pd.notna(pm25) else " --"
             pm10_str = str(int(pm10)).rjust(3) if pd.notna(pm10) else " --"
             
-            row += f" {pm25_str}  {pm10_str} "
+            parts.append(f" {pm25_str}  {pm10_str} ")
         
-        message += row + "\n"
+        parts.append("\n")
     
-    return message
+    return "".join(parts)
 
 def format_statistics_message(all_daily: pd.DataFrame) -> str:
     """
@@ -324,40 +357,26 @@ def format_statistics_message(all_daily: pd.DataFrame) -> str:
     station_order = ["仁武", "楠梓", "南區上", "南區下"]
     available_stations = [s for s in station_order if s in all_daily['device'].unique()]
     
-    message = "\n━━━━━━━━━━━━━━━\n"
-    message += "📊 統計摘要\n"
-    message += "━━━━━━━━━━━━━━━\n\n"
-    
-    # PM2.5 統計
-    message += "【PM2.5】(法規標準: 30μg/m³)\n"
-    message += "測站    最小  最大\n"
-    message += "─" * 20 + "\n"
+    # 各測站最小/最大值一次算好
+    stats = all_daily.groupby('device')[['PM2.5', 'PM10']].agg(['min', 'max'])
     
-    for station in available_stations:
-        station_data = all_daily[all_daily['device'] == station]
-        if not station_data.empty:
-            min_val = int(station_data['PM2.5'].min())
-            max_val = int(station_data['PM2.5'].max())
-            message += f"{station.ljust(6)} {str(min_val).rjust(3)}  {str(max_val).rjust(3)}\n"
+    parts = ["\n", _DIVIDER, "📊 統計摘要\n", _DIVIDER, "\n"]
     
-    message += "\n"
-    
-    # PM10 統計
-    message += "【PM10】(法規標準: 75μg/m³)\n"
-    message += "測站    最小  最大\n"
-    message += "─" * 20 + "\n"
-    
-    for station in available_stations:
-        station_data = all_daily[all_daily['device'] == station]
-        if not station_data.empty:
-            min_val = int(station_data['PM10'].min())
-            max_val = int(station_data['PM10'].max())
-            message += f"{station.ljust(6)} {str(min_val).rjust(3)}  {str(max_val).rjust(3)}\n"
+    for pollutant, limit in (("PM2.5", 30), ("PM10", 75)):
+        parts.append(f"【{pollutant}】(法規標準: {limit}μg/m³)\n")
+        parts.append("測站    最小  最大\n")
+        parts.append("─" * 20 + "\n")
+        
+        # 依測站順序取出 (最小, 最大) 陣列，逐列以位置讀取
+        min_max = stats[pollutant].reindex(available_stations)[['min', 'max']].to_numpy()
+        for station, (min_val, max_val) in zip(available_stations, min_max.astype(int).tolist()):
+            parts.append(f"{station.ljust(6)} {str(min_val).rjust(3)}  {str(max_val).rjust(3)}\n")
+        parts.append("\n")
     
-    message += "\n━━━━━━━━━━━━━━━\n"
-    message += "ℹ️ 資料來源：AirLink、環保署"
+    parts.append(_DIVIDER)
+    parts.append("ℹ️ 資料來源：AirLink、環保署")
     
-    return message
+    return "".join(parts)
 
 def query_historical_data(api_key: str, api_secret: str, station_id: str, 
                          moenv_token: str, start_date: datetime.date, 
@@ -384,9 +403,11 @@ def query_historical_data(api_key: str, api_secret: str, station_id: str,
         if (end_date - start_date).days > 30:
             return "❌ 查詢範圍不能超過 30 天"
         
-        # 取得資料
-        airlink_records = fetch_airlink_data_range(api_key, api_secret, station_id, start_date, end_date)
-        moenv_records = fetch_moenv_data_range(moenv_token, start_date, end_date)
+        # 取得資料：環保署在背景執行緒查詢，與 AirLink 同時進行
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            moenv_future = executor.submit(fetch_moenv_data_range, moenv_token, start_date, end_date)
+            airlink_records = fetch_airlink_data_range(api_key, api_secret, station_id, start_date, end_date)
+            moenv_records = moenv_future.result()
         
         # 計算每日平均
         all_daily = calculate_daily_averages(airlink_records, moenv_records)
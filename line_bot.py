@@ -10,21 +10,39 @@ LINE Bot - 與 Streamlit 完全一致版本
 
 from flask import Flask, request, abort
 from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
 from linebot.models import MessageEvent, TextMessage, TextSendMessage, QuickReply, QuickReplyButton, MessageAction
 import os
+import json
+import math
+import queue
+import logging
 import datetime
 import re
+import sqlite3
 import threading
-import requests
-import hmac
-import hashlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
 import time
-from typing import Dict, Optional
-from zoneinfo import ZoneInfo
+
+# orjson 解析較快；未安裝時退回標準函式庫（json.loads 同樣接受 bytes）
+try:
+    import orjson
+except ImportError:
+    import json as orjson
+
+from air_quality_api import (
+    AIRLINK_LSIDS, MOENV_SITE_FILTER, MOENV_TARGETS, MOENV_VERIFY, SIGNATURE_WINDOW, TW_TZ,
+    cached, clean_concentration, generate_historic_signature, get_session, historic_cache_ttl, historic_columns,
+    current_air_quality_message
+)
 
 app = Flask(__name__)
 
+# air_quality_api 改用 logging；webhook 只輸出 INFO 以上
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
 LINE_CHANNEL_ACCESS_TOKEN = os.getenv('LINE_CHANNEL_ACCESS_TOKEN', '')
 LINE_CHANNEL_SECRET = os.getenv('LINE_CHANNEL_SECRET', '')
 LIFF_ID = os.getenv('LIFF_ID', '')
@@ -32,37 +50,156 @@ API_KEY = os.getenv('API_KEY', '')
 API_SECRET = os.getenv('API_SECRET', '')
 STATION_ID = os.getenv('STATION_ID', '')
 MOENV_API_TOKEN = os.getenv('MOENV_API_TOKEN', '')
+REDIS_URL = os.getenv('REDIS_URL', '')
+
+class SessionHttpClient(RequestsHttpClient):
+    """LINE API 改走共用的 requests.Session（預設每次呼叫都重新建立 TLS 連線）"""
+    
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        response = get_session().get(url, headers=headers, params=params, stream=stream,
+                                     timeout=self.timeout if timeout is None else timeout)
+        return RequestsHttpResponse(response)
+    
+    def post(self, url, headers=None, data=None, timeout=None):
+        response = get_session().post(url, headers=headers, data=data,
+                                      timeout=self.timeout if timeout is None else timeout)
+        return RequestsHttpResponse(response)
+    
+    def put(self, url, headers=None, data=None, timeout=None):
+        response = get_session().put(url, headers=headers, data=data,
+                                     timeout=self.timeout if timeout is None else timeout)
+        return RequestsHttpResponse(response)
+    
+    def delete(self, url, headers=None, data=None, timeout=None):
+        response = get_session().delete(url, headers=headers, data=data,
+                                        timeout=self.timeout if timeout is None else timeout)
+        return RequestsHttpResponse(response)
 
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
+line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN, http_client=SessionHttpClient)
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
 
-user_states = {}
+# 使用者狀態：設定 REDIS_URL 時存放於 Redis（多個 worker 共用、重啟不遺失），否則存在本機記憶體；兩者皆 USER_STATE_TTL 秒後失效
+USER_STATE_TTL = 300
+# 本機模式最多保留的使用者數，超過時淘汰最早寫入（最快到期）的狀態
+USER_STATE_MAX = 10000
 
-TW_TZ = ZoneInfo("Asia/Taipei")
+if REDIS_URL:
+    import redis
+    _redis = redis.Redis(connection_pool=redis.ConnectionPool.from_url(REDIS_URL))
+else:
+    _redis = None
 
-AIRLINK_LSIDS = {
-    652269: "南區上",
-    655484: "南區下"
-}
+# 本機模式：user_id -> (到期時間, 狀態)；TTL 固定，依寫入順序即為到期順序
+user_states = OrderedDict()
+_states_lock = threading.Lock()
 
-# ==================== AirLink Historic API ====================
+def get_user_state(user_id):
+    """取得使用者狀態"""
+    if _redis is not None:
+        raw = _redis.get(f"st:{user_id}")
+        return json.loads(raw) if raw else {}
+    with _states_lock:
+        entry = user_states.get(user_id)
+    if entry is None or entry[0] <= time.monotonic():
+        return {}
+    return entry[1]
 
-def generate_signature(api_key, api_secret, t, station_id, start_ts, end_ts):
-    """簽名函數"""
-    parts = [
-        "api-key", api_key, 
-        "end-timestamp", str(end_ts), 
-        "start-timestamp", str(start_ts), 
-        "station-id", str(station_id), 
-        "t", str(t)
-    ]
-    data = "".join(parts)
-    return hmac.new(api_secret.encode(), data.encode(), hashlib.sha256).hexdigest()
+def set_user_state(user_id, state):
+    """設定使用者狀態（空 dict 代表清除）"""
+    if _redis is not None:
+        if state:
+            _redis.setex(f"st:{user_id}", USER_STATE_TTL, json.dumps(state))
+        else:
+            _redis.delete(f"st:{user_id}")
+        return
+    now = time.monotonic()
+    with _states_lock:
+        # 先清掉最舊的過期狀態（離開未回覆的使用者不會永久佔用記憶體）
+        while user_states:
+            user, (expires_at, _) = next(iter(user_states.items()))
+            if expires_at > now:
+                break
+            del user_states[user]
+        if state:
+            user_states[user_id] = (now + USER_STATE_TTL, state)
+            user_states.move_to_end(user_id)
+            if len(user_states) > USER_STATE_MAX:
+                user_states.popitem(last=False)
+        else:
+            user_states.pop(user_id, None)
+
+# 「今日」即時查詢的等待上限（秒）：兩個來源並行，逾時的來源略過，盡快回覆
+CURRENT_FETCH_TIMEOUT = 8
+
+# 歷史查詢背景執行（固定數量 worker，webhook 回覆後立即釋放）；可用環境變數調整
+HIST_POOL_SIZE = int(os.getenv('HIST_POOL_SIZE', '4'))
+_HISTORY_POOL = ThreadPoolExecutor(max_workers=HIST_POOL_SIZE, thread_name_prefix="hist")
+
+# 執行中 + 排隊中的查詢上限，超過時直接回覆忙線
+HISTORY_QUEUE_MAX = int(os.getenv('HIST_QUEUE_MAX', str(HIST_POOL_SIZE * 4)))
+_history_slots = threading.BoundedSemaphore(HISTORY_QUEUE_MAX)
+_BUSY_MSG = "⏳ 系統忙線中，請稍後再試"
+
+# 執行中的查詢（同一頁只查一次，後到的使用者共用結果）
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+def submit_historical_query(user_id, start_date, end_date, acknowledge):
+    """
+    排入背景查詢（只查第一頁）；相同頁面已在查詢中時直接等待其結果；佇列已滿時回傳 False
+    取得名額後先呼叫 acknowledge 回覆「查詢中」才開始查詢，快取命中時結果也不會比確認訊息先送達
+    """
+    page_end = min(end_date, start_date + datetime.timedelta(days=HISTORY_PAGE_DAYS - 1))
+    key = (start_date, page_end)
+    started = False
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        if future is None or future.done():
+            if not _history_slots.acquire(blocking=False):
+                return False
+            # 先占住這一頁，回覆確認訊息後才送進執行緒池
+            future = Future()
+            _in_flight[key] = future
+            started = True
+    try:
+        acknowledge()
+    finally:
+        # callback 在鎖外註冊：future 已完成時 callback 會在此執行緒立即執行
+        if started:
+            future.add_done_callback(lambda f: _finish_historical_query(key, f))
+            _HISTORY_POOL.submit(_run_historical_query, future, start_date, page_end)
+        future.add_done_callback(lambda f: push_historical_page(user_id, page_end, end_date, f))
+    return True
+
+def _run_historical_query(future, start_date, page_end):
+    """在執行緒池中查詢一頁，結果交給等待中的 future"""
+    try:
+        future.set_result(query_historical_cached(API_KEY, API_SECRET, STATION_ID, MOENV_API_TOKEN, start_date, page_end))
+    except Exception as e:
+        future.set_exception(e)
+
+def _finish_historical_query(key, future):
+    """查詢完成：移出執行中清單並釋放名額"""
+    with _in_flight_lock:
+        if _in_flight.get(key) is future:
+            del _in_flight[key]
+    _history_slots.release()
+
+# 日期範圍格式：2025/11/04-2025/11/06（可用民國年）或 11/4-11/6，整段文字需完全符合
+_DATE_RE_FULL = re.compile(r'(\d{3,4})/(\d{1,2})/(\d{1,2})-(\d{3,4})/(\d{1,2})/(\d{1,2})')
+_DATE_RE_SHORT = re.compile(r'(\d{1,2})/(\d{1,2})-(\d{1,2})/(\d{1,2})')
+
+# ==================== AirLink Historic API ====================
 
 def fetch_airlink_historical(api_key, api_secret, station_id, start_ts, end_ts):
-    """呼叫 AirLink Historic API"""
-    t = int(time.time())
-    signature = generate_signature(api_key, api_secret, t, station_id, start_ts, end_ts)
+    """呼叫 AirLink Historic API，回傳各測站 (ts, PM2.5, PM10) 欄位（已結束的日期快取一天，含今天者快取 5 分鐘）"""
+    key = ("airlink-historic", api_key, station_id, start_ts, end_ts)
+    return cached(key, historic_cache_ttl(end_ts), _fetch_airlink_historical, api_key, api_secret, station_id, start_ts, end_ts)
+
+def _fetch_airlink_historical(api_key, api_secret, station_id, start_ts, end_ts):
+    """實際呼叫 AirLink Historic API"""
+    t = int(time.time()) // SIGNATURE_WINDOW * SIGNATURE_WINDOW
+    signature = generate_historic_signature(api_key, api_secret, t, station_id, start_ts, end_ts)
     url = f"https://api.weatherlink.com/v2/historic/{station_id}"
     params = {
         "api-key": api_key, 
@@ -73,11 +210,11 @@ def fetch_airlink_historical(api_key, api_secret, station_id, start_ts, end_ts):
     }
     
     try:
-        resp = requests.get(url, params=params, timeout=30)
+        resp = get_session().get(url, params=params, timeout=30)
         if resp.status_code != 200:
             print(f"❌ AirLink Historic API 錯誤: {resp.status_code}")
             return None
-        return resp.json()
+        return historic_columns(orjson.loads(resp.content))
     except Exception as e:
         print(f"❌ AirLink Historic API 異常: {e}")
         return None
@@ -96,27 +233,23 @@ def fetch_moenv_historical(api_token, date_str):
             "limit": 1000,
             "sort": "datacreationdate desc",
             "format": "json",
-            "filters": f"datacreationdate,eq,{date_str}"
+            "filters": f"datacreationdate,eq,{date_str}|{MOENV_SITE_FILTER}"
         }
         
         print(f"   查詢環保署 {date_str}")
         
-        response = requests.get(url, params=params, timeout=15, verify=False)
+        response = get_session().get(url, params=params, timeout=15, verify=MOENV_VERIFY)
         
         if response.status_code != 200:
             print(f"   ❌ 環保署 API 錯誤: {response.status_code}")
             return []
         
-        data = response.json()
+        data = orjson.loads(response.content)
         records = data.get("records", [])
         print(f"   ✅ 環保署: {len(records)} 筆原始資料")
         
-        # 篩選仁武、楠梓
-        filtered = []
-        for record in records:
-            site_name = record.get("sitename", "")
-            if site_name in ["仁武", "楠梓"]:
-                filtered.append(record)
+        # 伺服器已篩選測站，這裡僅做保險
+        filtered = [record for record in records if record.get("sitename") in MOENV_TARGETS]
         
         print(f"   ✅ 仁武+楠梓: {len(filtered)} 筆")
         return filtered
@@ -125,21 +258,164 @@ def fetch_moenv_historical(api_token, date_str):
         print(f"   ❌ 環保署 API 異常: {e}")
         return []
 
-def clean_concentration(value):
-    """清理濃度值"""
-    if not value:
-        return None
-    value_str = str(value).strip()
-    invalid_markers = ['#', '*', 'x', 'A', 'NR', 'ND', '', '-']
-    if value_str in invalid_markers or any(m in value_str for m in invalid_markers if m):
+# ==================== 歷史查詢主函數 ====================
+
+# 歷史查詢同時處理的天數（WeatherLink / 環保署皆有限速）
+HISTORY_DAY_WORKERS = 3
+
+# 回覆訊息固定片段與測站顯示順序：仁武、楠梓、南區上、南區下
+_DIVIDER = "━━━━━━━━━━━━━━━\n"
+_HISTORY_HEADER = "📊 每日平均值\n" + _DIVIDER + "\n"
+_HISTORY_FOOTER_TMPL = _DIVIDER + "📊 總計 {total} 筆資料\nℹ️ 資料來源：AirLink、環保署"
+_DEVICE_ORDER = ("仁武", "楠梓", "南區上", "南區下")
+
+# 已結束日期的每日累計值存於 SQLite（資料不再變動，重啟後仍可直接使用）
+HISTORY_CACHE_DB = os.getenv('HISTORY_CACHE_DB', 'history_cache.db')
+_history_db = sqlite3.connect(HISTORY_CACHE_DB, check_same_thread=False)
+_history_db.execute(
+    "CREATE TABLE IF NOT EXISTS daily (station TEXT, day TEXT, device TEXT, records INTEGER, "
+    "sum_pm25 REAL, cnt_pm25 INTEGER, sum_pm10 REAL, cnt_pm10 INTEGER, PRIMARY KEY (station, day, device))"
+)
+# 已結束日期範圍的完整回覆訊息（每日資料皆齊全才寫入），保留 HISTORY_RESULT_DAYS 天
+_history_db.execute(
+    "CREATE TABLE IF NOT EXISTS results (station TEXT, start_day TEXT, end_day TEXT, message TEXT, "
+    "created REAL, PRIMARY KEY (station, start_day, end_day))"
+)
+HISTORY_RESULT_DAYS = 30
+_history_db_lock = threading.Lock()
+
+# 日期結束後經過這段時間才寫入 SQLite（環保署逐時資料會延遲發布）
+HISTORY_SETTLE = datetime.timedelta(hours=3)
+# 視為完整的一天：環保署每站至少這麼多小時的資料，AirLink 資料需涵蓋到當日最後一小時
+MOENV_MIN_DAY_HOURS = 22
+AIRLINK_MAX_END_GAP = 3600
+
+def load_day_sums(station_id, current_date):
+    """讀取已快取的單日累計值，沒有時回傳 None"""
+    with _history_db_lock:
+        rows = _history_db.execute(
+            "SELECT device, records, sum_pm25, cnt_pm25, sum_pm10, cnt_pm10 FROM daily WHERE station = ? AND day = ?",
+            (station_id, current_date.isoformat())
+        ).fetchall()
+    if not rows:
         return None
+    return {device: tuple(values) for device, *values in rows}
+
+def store_day_sums(station_id, current_date, sums):
+    """寫入單日累計值（寫入失敗只記錄，不影響查詢結果）"""
+    day = current_date.isoformat()
     try:
-        numeric_value = float(value_str)
-        return numeric_value if 0 <= numeric_value <= 1000 else None
-    except:
-        return None
+        with _history_db_lock, _history_db:
+            _history_db.executemany(
+                "INSERT OR REPLACE INTO daily VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(station_id, day, device, *values) for device, values in sums.items()]
+            )
+    except sqlite3.Error as e:
+        print(f"⚠️ 每日快取寫入失敗: {e}")
 
-# ==================== 歷史查詢主函數 ====================
+def load_result(station_id, start_date, end_date):
+    """讀取已快取的查詢結果訊息，沒有時回傳 None"""
+    with _history_db_lock:
+        row = _history_db.execute(
+            "SELECT message FROM results WHERE station = ? AND start_day = ? AND end_day = ?",
+            (station_id, start_date.isoformat(), end_date.isoformat())
+        ).fetchone()
+    return row[0] if row else None
+
+def store_result(station_id, start_date, end_date, message):
+    """範圍內每一天的累計值都已存入 daily 時才寫入結果（避免保存缺資料的訊息），並清除過期結果；寫入失敗只記錄"""
+    days = (end_date - start_date).days + 1
+    now = time.time()
+    try:
+        with _history_db_lock, _history_db:
+            stored_days = _history_db.execute(
+                "SELECT COUNT(DISTINCT day) FROM daily WHERE station = ? AND day BETWEEN ? AND ?",
+                (station_id, start_date.isoformat(), end_date.isoformat())
+            ).fetchone()[0]
+            if stored_days < days:
+                return
+            _history_db.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)",
+                (station_id, start_date.isoformat(), end_date.isoformat(), message, now)
+            )
+            _history_db.execute("DELETE FROM results WHERE created < ?", (now - HISTORY_RESULT_DAYS * 86400,))
+    except sqlite3.Error as e:
+        print(f"⚠️ 查詢結果快取寫入失敗: {e}")
+
+def fetch_day_sums(api_key, api_secret, station_id, moenv_token, current_date):
+    """單日累計值：已結束的日期先查 SQLite；資料完整且已過 HISTORY_SETTLE 才寫入"""
+    now = datetime.datetime.now(TW_TZ)
+    finished = current_date < now.date()
+    if finished:
+        sums = load_day_sums(station_id, current_date)
+        if sums is not None:
+            print(f"\n📅 {current_date} 使用快取")
+            return sums
+    
+    sums, complete = fetch_day_records(api_key, api_secret, station_id, moenv_token, current_date)
+    day_end = datetime.datetime.combine(current_date + datetime.timedelta(days=1), datetime.time.min, tzinfo=TW_TZ)
+    if complete and now >= day_end + HISTORY_SETTLE:
+        store_day_sums(station_id, current_date, sums)
+    return sums
+
+def fetch_day_records(api_key, api_secret, station_id, moenv_token, current_date):
+    """查詢單日 AirLink 與環保署資料，回傳 ({裝置: (筆數, PM2.5 總和, 筆數, PM10 總和, 筆數)}, 四個測站資料皆涵蓋整天)"""
+    sums = {}
+    airlink_last_ts = {}
+    print(f"\n📅 查詢 {current_date}")
+    
+    # 台灣時間當日的秒數範圍（與伺服器時區無關），逐筆只需整數比較
+    day_start_ts = int(datetime.datetime.combine(current_date, datetime.time.min, tzinfo=TW_TZ).timestamp())
+    day_end_ts = day_start_ts + 86400
+    
+    print(f"   時間戳記: {day_start_ts} ~ {day_end_ts}")
+    
+    def accumulate(device, pm25, pm10):
+        # 只保留累計值，不留存逐筆紀錄
+        n, s25, c25, s10, c10 = sums.get(device, (0, 0.0, 0, 0.0, 0))
+        if pm25 is not None:
+            s25 += round(pm25, 1)
+            c25 += 1
+        if pm10 is not None:
+            s10 += round(pm10, 1)
+            c10 += 1
+        sums[device] = (n + 1, s25, c25, s10, c10)
+    
+    # 1. 查詢 AirLink
+    airlink_data = fetch_airlink_historical(api_key, api_secret, station_id, day_start_ts, day_end_ts)
+    
+    if airlink_data:
+        for device_name, (ts_col, pm25_col, pm10_col) in airlink_data.items():
+            print(f"   AirLink {device_name}: {len(ts_col)} 筆")
+            
+            for ts, pm25, pm10 in zip(ts_col, pm25_col, pm10_col):
+                # 🔥 只保留目標日期（台灣時間）的資料
+                if not day_start_ts <= ts < day_end_ts:
+                    continue
+                
+                airlink_last_ts[device_name] = max(ts, airlink_last_ts.get(device_name, 0))
+                accumulate(device_name, None if math.isnan(pm25) else pm25, None if math.isnan(pm10) else pm10)
+    
+    # 2. 查詢環保署
+    date_str_api = current_date.strftime("%Y-%m-%d")
+    moenv_records = fetch_moenv_historical(moenv_token, date_str_api)
+    
+    for record in moenv_records:
+        site_name = record.get("sitename", "")
+        pm25 = clean_concentration(record.get("pm2.5", ""))
+        pm10 = clean_concentration(record.get("pm10", ""))
+        
+        if pm25 is not None or pm10 is not None:
+            accumulate(site_name, pm25, pm10)
+    
+    complete = (
+        all(airlink_last_ts.get(device, 0) >= day_end_ts - AIRLINK_MAX_END_GAP for device in AIRLINK_LSIDS.values())
+        and all(sums.get(site, (0,))[0] >= MOENV_MIN_DAY_HOURS for site in MOENV_TARGETS)
+    )
+    return sums, complete
+
+# 查詢失敗訊息開頭（與「期間無資料」區分）
+_QUERY_FAILED = "❌ 查詢失敗:"
 
 def query_historical_data(api_key, api_secret, station_id, moenv_token, start_date, end_date):
     """
@@ -150,170 +426,128 @@ def query_historical_data(api_key, api_secret, station_id, moenv_token, start_da
         print(f"🔍 開始歷史查詢: {start_date} ~ {end_date}")
         print("=" * 70)
         
-        all_records = []
+        daily_avg = {}
+        total = 0
         
-        # 🔥 修正：逐日查詢，只保留目標日期的資料
-        current_date = start_date
-        while current_date <= end_date:  # 使用 <= 而非 <
-            print(f"\n📅 查詢 {current_date}")
-            
-            # 計算該日的時間戳記範圍
-            current_dt = datetime.datetime.combine(current_date, datetime.time.min)
-            next_dt = current_dt + datetime.timedelta(days=1)
-            
-            start_ts = int(current_dt.timestamp())
-            end_ts = int(next_dt.timestamp())
-            
-            print(f"   時間戳記: {start_ts} ~ {end_ts}")
-            
-            # 1. 查詢 AirLink
-            airlink_data = fetch_airlink_historical(api_key, api_secret, station_id, start_ts, end_ts)
-            
-            if airlink_data:
-                sensors = airlink_data.get("sensors", [])
-                for sensor in sensors:
-                    lsid = sensor.get("lsid")
-                    if lsid not in AIRLINK_LSIDS:
-                        continue
-                    
-                    device_name = AIRLINK_LSIDS[lsid]
-                    sensor_data = sensor.get("data", [])
-                    print(f"   AirLink {device_name}: {len(sensor_data)} 筆")
-                    
-                    for record in sensor_data:
-                        ts = record.get("ts")
-                        if not ts:
-                            continue
-                        
-                        # 使用 TW_TZ 格式化
-                        timestamp = datetime.datetime.fromtimestamp(ts, tz=TW_TZ)
-                        record_date = timestamp.date()
-                        
-                        # 🔥 只保留目標日期的資料
-                        if record_date != current_date:
-                            continue
-                        
-                        date_str = timestamp.strftime("%Y/%m/%d")
-                        
-                        pm25 = record.get("pm_2p5_avg") or record.get("pm_2p5") or record.get("pm_2p5_last")
-                        pm10 = record.get("pm_10_avg") or record.get("pm_10") or record.get("pm_10_last")
-                        
-                        if pm25 is not None or pm10 is not None:
-                            all_records.append({
-                                "device": device_name,
-                                "date": date_str,
-                                "PM2.5": round(pm25, 1) if pm25 else None,
-                                "PM10": round(pm10, 1) if pm10 else None
-                            })
-            
-            # 2. 查詢環保署
-            date_str_api = current_date.strftime("%Y-%m-%d")
-            moenv_records = fetch_moenv_historical(moenv_token, date_str_api)
-            
-            for record in moenv_records:
-                site_name = record.get("sitename", "")
-                pm25 = clean_concentration(record.get("pm2.5", ""))
-                pm10 = clean_concentration(record.get("pm10", ""))
-                
-                if pm25 is not None or pm10 is not None:
-                    all_records.append({
-                        "device": site_name,
-                        "date": current_date.strftime("%Y/%m/%d"),
-                        "PM2.5": round(pm25, 1) if pm25 else None,
-                        "PM10": round(pm10, 1) if pm10 else None
-                    })
-            
-            current_date += datetime.timedelta(days=1)
-            time.sleep(0.5)
+        # 🔥 修正：逐日查詢（含結束日），多天同時進行，map 依日期順序回傳
+        days = [start_date + datetime.timedelta(days=n) for n in range((end_date - start_date).days + 1)]
+        with ThreadPoolExecutor(max_workers=HISTORY_DAY_WORKERS) as executor:
+            for day, sums in zip(days, executor.map(
+                lambda day: fetch_day_sums(api_key, api_secret, station_id, moenv_token, day), days
+            )):
+                if sums:
+                    daily_avg[day.strftime("%Y/%m/%d")] = sums
+                    total += sum(values[0] for values in sums.values())
         
         print(f"\n{'='*70}")
-        print(f"📊 查詢完成: 總計 {len(all_records)} 筆")
+        print(f"📊 查詢完成: 總計 {total} 筆")
         print(f"{'='*70}\n")
         
-        if not all_records:
+        if not total:
             return f"❌ {start_date} ~ {end_date} 期間無資料"
         
-        # 計算每日平均
-        daily_avg = {}
-        for record in all_records:
-            key = (record["device"], record["date"])
-            if key not in daily_avg:
-                daily_avg[key] = {"pm25": [], "pm10": []}
-            
-            if record["PM2.5"]:
-                daily_avg[key]["pm25"].append(record["PM2.5"])
-            if record["PM10"]:
-                daily_avg[key]["pm10"].append(record["PM10"])
-        
-        # 格式化訊息
-        message = f"📅 查詢期間: {start_date.strftime('%Y/%m/%d')} ~ {end_date.strftime('%Y/%m/%d')}\n\n"
-        message += "📊 每日平均值\n━━━━━━━━━━━━━━━\n\n"
-        
-        dates = sorted(set(record["date"] for record in all_records))
+        # 格式化訊息（逐段收集後一次 join）
+        parts = [
+            f"📅 查詢期間: {start_date.strftime('%Y/%m/%d')} ~ {end_date.strftime('%Y/%m/%d')}\n\n",
+            _HISTORY_HEADER,
+        ]
         
-        for date_str in dates:
-            parts = date_str.split('/')
-            year_roc = int(parts[0]) - 1911
-            date_roc = f"{year_roc}/{parts[1]}/{parts[2]}"
+        for date_str, sums in daily_avg.items():
+            year, month, day = date_str.split('/', 2)
+            parts.append(f"【{int(year) - 1911}/{month}/{day}】\n")
             
-            message += f"【{date_roc}】\n"
-            
-            # 按順序顯示：仁武、楠梓、南區上、南區下
-            for device in ["仁武", "楠梓", "南區上", "南區下"]:
-                key = (device, date_str)
-                if key in daily_avg:
-                    pm25_list = daily_avg[key]["pm25"]
-                    pm10_list = daily_avg[key]["pm10"]
-                    
-                    pm25_avg = round(sum(pm25_list) / len(pm25_list)) if pm25_list else None
-                    pm10_avg = round(sum(pm10_list) / len(pm10_list)) if pm10_list else None
-                    
-                    pm25_str = str(pm25_avg) if pm25_avg else "--"
-                    pm10_str = str(pm10_avg) if pm10_avg else "--"
-                    
-                    message += f"  {device}: PM2.5={pm25_str}, PM10={pm10_str}\n"
-            message += "\n"
+            for device in _DEVICE_ORDER:
+                if device in sums:
+                    _, s25, c25, s10, c10 = sums[device]
+                    pm25_str = str(round(s25 / c25)) if c25 else "--"
+                    pm10_str = str(round(s10 / c10)) if c10 else "--"
+                    parts.append(f"  {device}: PM2.5={pm25_str}, PM10={pm10_str}\n")
+            parts.append("\n")
         
-        message += f"━━━━━━━━━━━━━━━\n📊 總計 {len(all_records)} 筆資料\nℹ️ 資料來源：AirLink、環保署"
+        parts.append(_HISTORY_FOOTER_TMPL.format(total=total))
         
-        return message
+        return "".join(parts)
         
     except Exception as e:
         print(f"❌ 查詢異常: {e}")
         import traceback
         traceback.print_exc()
-        return f"❌ 查詢失敗: {str(e)}"
+        return f"{_QUERY_FAILED} {str(e)}"
 
-def query_historical_async(user_id, start_date, end_date):
-    """背景執行查詢"""
+def query_historical_cached(api_key, api_secret, station_id, moenv_token, start_date, end_date):
+    """
+    歷史查詢結果快取：已結束的日期範圍快取一天（並存入 SQLite），含今天者快取 5 分鐘
+    錯誤或無資料的訊息不快取
+    """
+    end_ts = int(datetime.datetime.combine(end_date + datetime.timedelta(days=1), datetime.time.min, tzinfo=TW_TZ).timestamp())
+    failure = []
+    
+    finished = end_date < datetime.datetime.now(TW_TZ).date()
+    
+    def run():
+        # 已結束的範圍先查磁碟上的結果，重啟後也不必重新查詢
+        if finished:
+            message = load_result(station_id, start_date, end_date)
+            if message is not None:
+                return message
+        message = query_historical_data(api_key, api_secret, station_id, moenv_token, start_date, end_date)
+        if message.startswith("❌"):
+            failure.append(message)
+            return None
+        if finished:
+            store_result(station_id, start_date, end_date, message)
+        return message
+    
+    return cached(("history", station_id, start_date, end_date), historic_cache_ttl(end_ts), run) or failure[0]
+
+# 歷史查詢分頁：每頁天數
+HISTORY_PAGE_DAYS = 3
+
+# LINE 單則文字上限 5000 字，保留餘裕；單次 push 最多 5 則訊息
+MESSAGE_CHUNK_SIZE = 4500
+MAX_MESSAGES_PER_PUSH = 5
+
+def split_message(text, limit=MESSAGE_CHUNK_SIZE):
+    """在 limit 內最後一個換行處切分長訊息（每段直接切片，不逐行處理）"""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit)
+        if cut <= 0:
+            # 單行超過上限時硬切
+            parts.append(text[:limit])
+            text = text[limit:]
+        else:
+            parts.append(text[:cut])
+            text = text[cut + 1:]
+    parts.append(text)
+    return parts
+
+def push_historical_page(user_id, page_end, end_date, future):
+    """推播一頁查詢結果；推播成功後才把其餘日期記錄在使用者狀態等待「下一頁」"""
     try:
-        result = query_historical_data(API_KEY, API_SECRET, STATION_ID, MOENV_API_TOKEN, start_date, end_date)
+        result = future.result()
         
-        if len(result) > 4500:
-            parts = []
-            current = ""
-            for line in result.split('\n'):
-                if len(current) + len(line) + 1 < 4500:
-                    current += line + '\n'
-                else:
-                    parts.append(current)
-                    current = line + '\n'
-            if current:
-                parts.append(current)
-            
-            for i, part in enumerate(parts):
-                line_bot_api.push_message(
-                    user_id,
-                    TextSendMessage(
-                        text=part,
-                        quick_reply=create_main_menu_quick_reply() if i == len(parts)-1 else None
-                    )
-                )
+        # 查詢失敗時不提供下一頁；這頁只是無資料時仍可繼續查下一頁
+        has_next = page_end < end_date and not result.startswith(_QUERY_FAILED)
+        if has_next:
+            next_start = page_end + datetime.timedelta(days=1)
+            quick_reply = create_next_page_quick_reply()
+            result += f"\n\n➡️ 尚有 {next_start.strftime('%m/%d')} ~ {end_date.strftime('%m/%d')}，點「下一頁」繼續"
         else:
-            line_bot_api.push_message(
-                user_id,
-                TextSendMessage(text=result, quick_reply=create_main_menu_quick_reply())
-            )
+            quick_reply = create_main_menu_quick_reply()
+        
+        # 長訊息切段後合併推播：每次 push 最多 5 則，通常一次呼叫即可
+        parts = split_message(result) if len(result) > MESSAGE_CHUNK_SIZE else [result]
+        last = len(parts) - 1
+        messages = [
+            TextSendMessage(text=part, quick_reply=quick_reply if i == last else None)
+            for i, part in enumerate(parts)
+        ]
+        for i in range(0, len(messages), MAX_MESSAGES_PER_PUSH):
+            line_bot_api.push_message(user_id, messages[i:i + MAX_MESSAGES_PER_PUSH])
+        
+        if has_next:
+            set_user_state(user_id, {'next_page': [next_start.isoformat(), end_date.isoformat()]})
             
     except Exception as e:
         print(f"❌ 背景查詢異常: {e}")
@@ -322,141 +556,6 @@ def query_historical_async(user_id, start_date, end_date):
             TextSendMessage(text=f"❌ 查詢失敗: {str(e)}", quick_reply=create_main_menu_quick_reply())
         )
 
-# ==================== Current API ====================
-
-def generate_current_signature(api_key, api_secret, t, station_id):
-    parts = ["api-key", api_key, "station-id", str(station_id), "t", str(t)]
-    data = "".join(parts)
-    return hmac.new(api_secret.encode(), data.encode(), hashlib.sha256).hexdigest()
-
-def get_current_airlink_data(api_key, api_secret, station_id):
-    try:
-        t = int(time.time())
-        signature = generate_current_signature(api_key, api_secret, t, station_id)
-        url = f"https://api.weatherlink.com/v2/current/{station_id}"
-        params = {"api-key": api_key, "t": t, "api-signature": signature}
-        response = requests.get(url, params=params, timeout=10)
-        
-        if response.status_code == 200:
-            data = response.json()
-            result = {}
-            current_time = datetime.datetime.now(TW_TZ)
-            
-            for sensor in data.get("sensors", []):
-                lsid = sensor.get("lsid")
-                if lsid in AIRLINK_LSIDS:
-                    station_name = AIRLINK_LSIDS[lsid]
-                    sensor_data = sensor.get("data", [])
-                    if sensor_data:
-                        latest = sensor_data[0]
-                        pm25 = latest.get("pm_2p5_last") or latest.get("pm_2p5")
-                        pm10 = latest.get("pm_10_last") or latest.get("pm_10")
-                        data_ts = latest.get("ts")
-                        
-                        if data_ts:
-                            data_time = datetime.datetime.fromtimestamp(data_ts, tz=TW_TZ)
-                            time_label = data_time.strftime("%m/%d %H:%M")
-                        else:
-                            time_label = current_time.strftime("%m/%d %H:%M")
-                        
-                        if pm25 is not None or pm10 is not None:
-                            result[station_name] = {
-                                "PM2.5": round(pm25, 1) if pm25 else None,
-                                "PM10": round(pm10, 1) if pm10 else None,
-                                "time": time_label
-                            }
-            return result if result else None
-        return None
-    except Exception as e:
-        print(f"❌ Current API 錯誤: {e}")
-        return None
-
-def get_current_moenv_data(api_token):
-    try:
-        url = "https://data.moenv.gov.tw/api/v2/aqx_p_432"
-        params = {"api_key": api_token, "limit": 100, "format": "json"}
-        response = requests.get(url, params=params, timeout=10, verify=False)
-        
-        if response.status_code == 200:
-            result = {}
-            for record in response.json().get("records", []):
-                site_name = record.get("sitename", "")
-                if site_name in ["仁武", "楠梓"]:
-                    pm25 = clean_concentration(record.get("pm2.5", ""))
-                    pm10 = clean_concentration(record.get("pm10", ""))
-                    
-                    if pm25 is not None or pm10 is not None:
-                        publish_time = record.get("publishtime", "")
-                        try:
-                            dt = datetime.datetime.strptime(publish_time, "%Y-%m-%d %H:%M:%S")
-                            time_str = dt.strftime("%m/%d %H:%M")
-                        except:
-                            time_str = publish_time
-                        
-                        result[site_name] = {
-                            "PM2.5": round(pm25, 1) if pm25 else None,
-                            "PM10": round(pm10, 1) if pm10 else None,
-                            "time": time_str
-                        }
-            return result if result else None
-        return None
-    except Exception as e:
-        print(f"❌ 環保署即時錯誤: {e}")
-        return None
-
-def get_aqi_level(pm25_value):
-    if pm25_value is None:
-        return "❓ 無資料", ""
-    try:
-        pm25 = float(pm25_value)
-        if pm25 <= 15:
-            return "😊 優良", "#00E400"
-        elif pm25 <= 30:
-            return "🙂 良好", "#FFFF00"
-        elif pm25 <= 50:
-            return "😐 普通", "#FF7E00"
-        elif pm25 <= 100:
-            return "😷 不良", "#FF0000"
-        else:
-            return "☠️ 非常不良", "#7E0023"
-    except:
-        return "❓ 無資料", ""
-
-def format_air_quality_message(data):
-    if not data:
-        return "❌ 無法取得資料"
-    
-    current_time = datetime.datetime.now(TW_TZ).strftime("%m/%d %H:%M")
-    message = f"🕐 查詢時間: {current_time}\n\n📊 最新空氣品質\n━━━━━━━━━━━━━━━\n\n"
-    
-    for station in ["仁武", "楠梓", "南區上", "南區下"]:
-        if station in data:
-            values = data[station]
-            pm25 = values.get("PM2.5")
-            pm10 = values.get("PM10")
-            time_str = values.get("time", "")
-            level, _ = get_aqi_level(pm25)
-            
-            message += f"📍 {station}\n"
-            if pm25 is not None:
-                exceed = " ⚠️" if pm25 > 30 else ""
-                message += f"  PM2.5: {pm25} μg/m³{exceed}  {level}\n"
-            else:
-                message += f"  PM2.5: -- μg/m³\n"
-            
-            if pm10 is not None:
-                exceed = " ⚠️" if pm10 > 75 else ""
-                message += f"  PM10:  {pm10} μg/m³{exceed}\n"
-            else:
-                message += f"  PM10:  -- μg/m³\n"
-            
-            if time_str:
-                message += f"  📝 資料時間: {time_str}\n"
-            message += "\n"
-    
-    message += "━━━━━━━━━━━━━━━\n📌 法規標準（24小時平均值）\n• PM2.5 ≤ 30 μg/m³\n• PM10  ≤ 75 μg/m³\n\nℹ️ 資料來源：AirLink、環保署"
-    return message
-
 # ==================== LINE Bot ====================
 
 def create_main_menu_quick_reply():
@@ -466,8 +565,20 @@ def create_main_menu_quick_reply():
         QuickReplyButton(action=MessageAction(label="🌐 開啟系統", text="開啟查詢系統"))
     ])
 
+def create_next_page_quick_reply():
+    """歷史查詢還有下一頁時的按鈕（下一頁 + 主選單）"""
+    return QuickReply(items=[
+        QuickReplyButton(action=MessageAction(label="➡️ 下一頁", text="下一頁")),
+        *create_main_menu_quick_reply().items
+    ])
+
 def create_date_range_examples_quick_reply():
-    today = datetime.date.today()
+    return _build_date_range_quick_reply(datetime.date.today().toordinal())
+
+@lru_cache(maxsize=2)
+def _build_date_range_quick_reply(today_ordinal):
+    """日期範例按鈕（同一天內重複使用）"""
+    today = datetime.date.fromordinal(today_ordinal)
     yesterday = today - datetime.timedelta(days=1)
     
     return QuickReply(items=[
@@ -479,8 +590,7 @@ def create_date_range_examples_quick_reply():
 def parse_date_range(text):
     try:
         text = text.strip()
-        pattern1 = r'(\d{3,4})/(\d{1,2})/(\d{1,2})-(\d{3,4})/(\d{1,2})/(\d{1,2})'
-        match = re.match(pattern1, text)
+        match = _DATE_RE_FULL.fullmatch(text)
         if match:
             y1, m1, d1, y2, m2, d2 = match.groups()
             y1, y2 = int(y1), int(y2)
@@ -490,101 +600,166 @@ def parse_date_range(text):
                 y2 += 1911
             return (datetime.date(y1, int(m1), int(d1)), datetime.date(y2, int(m2), int(d2)))
         
-        pattern2 = r'(\d{1,2})/(\d{1,2})-(\d{1,2})/(\d{1,2})'
-        match = re.match(pattern2, text)
+        match = _DATE_RE_SHORT.fullmatch(text)
         if match:
             m1, d1, m2, d2 = match.groups()
             current_year = datetime.date.today().year
             return (datetime.date(current_year, int(m1), int(d1)), datetime.date(current_year, int(m2), int(d2)))
         
         return (None, None)
-    except:
+    except ValueError:
+        # 月/日超出範圍
         return (None, None)
 
 @app.route('/health', methods=['GET'])
 def health_check():
     return 'OK', 200
 
+# webhook 驗證簽名後立即回 200，事件交給背景 worker 處理（LINE 要求 webhook 盡快回應）
+EVENT_WORKERS = int(os.getenv('EVENT_WORKERS', '8'))
+EVENT_QUEUE_MAX = 1024
+_event_queue = queue.Queue(maxsize=EVENT_QUEUE_MAX)
+
+def _event_worker():
+    """取出 webhook 內容並分派給 handler"""
+    while True:
+        body, signature = _event_queue.get()
+        try:
+            handler.handle(body, signature)
+        except Exception:
+            logging.exception("❌ 事件處理異常")
+        finally:
+            _event_queue.task_done()
+
+for _ in range(EVENT_WORKERS):
+    threading.Thread(target=_event_worker, name="event", daemon=True).start()
+
 @app.route("/callback", methods=['POST'])
 def callback():
     signature = request.headers['X-Line-Signature']
     body = request.get_data(as_text=True)
+    if not handler.parser.signature_validator.validate(body, signature):
+        abort(400)
     try:
+        _event_queue.put_nowait((body, signature))
+    except queue.Full:
+        # 佇列已滿時退回同步處理，避免遺失事件
         handler.handle(body, signature)
-    except InvalidSignatureError:
-        abort(400)
     return 'OK'
 
+# reply token 約 1 分鐘內有效；事件排隊過久時改用 push
+REPLY_TOKEN_MAX_AGE = 25
+
+def reply(event, message):
+    """回覆訊息：事件仍新時用 reply（免費額度），過久則 push 給使用者"""
+    if time.time() - event.timestamp / 1000 <= REPLY_TOKEN_MAX_AGE:
+        line_bot_api.reply_message(event.reply_token, message)
+    else:
+        line_bot_api.push_message(event.source.user_id, message)
+
+# ==================== 指令 ====================
+
+def reply_today(event, user_id, user_state):
+    """今日空品"""
+    message = current_air_quality_message(API_KEY, API_SECRET, STATION_ID, MOENV_API_TOKEN, CURRENT_FETCH_TIMEOUT)
+    reply(event, TextSendMessage(text=message, quick_reply=create_main_menu_quick_reply()))
+
+def reply_history_prompt(event, user_id, user_state):
+    """進入歷史查詢，等待日期範圍"""
+    set_user_state(user_id, {'waiting_for_date_range': True})
+    reply(event, TextSendMessage(text="📅 請輸入日期範圍\n\n格式：2025/11/04-2025/11/06\n或：11/4-11/6\n\n💡 建議 7 天以內", quick_reply=create_date_range_examples_quick_reply()))
+
+def reply_next_page(event, user_id, user_state):
+    """歷史查詢下一頁"""
+    next_page = user_state.get('next_page')
+    if not next_page:
+        reply(event, TextSendMessage(text="ℹ️ 沒有下一頁", quick_reply=create_main_menu_quick_reply()))
+        return
+    
+    start_date, end_date = (datetime.date.fromisoformat(d) for d in next_page)
+    set_user_state(user_id, {})
+    acknowledge = lambda: reply(event, TextSendMessage(text="🔍 查詢下一頁中..."))
+    if not submit_historical_query(user_id, start_date, end_date, acknowledge):
+        set_user_state(user_id, user_state)
+        reply(event, TextSendMessage(text=_BUSY_MSG, quick_reply=create_next_page_quick_reply()))
+
+def reply_menu(event, user_id, user_state):
+    """主選單"""
+    message = "🌟 南區案空氣品質查詢系統\n\n請選擇功能：\n\n📊 今日空品\n📅 歷史查詢\n🌐 開啟系統"
+    reply(event, TextSendMessage(text=message, quick_reply=create_main_menu_quick_reply()))
+
+def reply_open_system(event, user_id, user_state):
+    """LIFF 完整查詢系統連結"""
+    if LIFF_ID:
+        message = f"🌐 完整查詢系統：\nhttps://liff.line.me/{LIFF_ID}"
+    else:
+        message = "⚠️ 請設定 LIFF"
+    reply(event, TextSendMessage(text=message, quick_reply=create_main_menu_quick_reply()))
+
+# 指令文字 → 處理函數（一次 dict 查詢取代逐一比對）
+_COMMANDS = {
+    "今日": reply_today,
+    "今天": reply_today,
+    "歷史查詢": reply_history_prompt,
+    "歷史資料": reply_history_prompt,
+    "下一頁": reply_next_page,
+    "選單": reply_menu,
+    "功能": reply_menu,
+    "開啟查詢系統": reply_open_system,
+    "開啟系統": reply_open_system,
+}
+
 @handler.add(MessageEvent, message=TextMessage)
 def handle_message(event):
     user_id = event.source.user_id
     text = event.message.text.strip()
-    user_state = user_states.get(user_id, {})
+    user_state = get_user_state(user_id)
     
     if user_state.get('waiting_for_date_range'):
         start_date, end_date = parse_date_range(text)
         
         if start_date and end_date:
             if start_date > end_date:
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ 開始日期不能晚於結束日期", quick_reply=create_date_range_examples_quick_reply()))
+                reply(event, TextSendMessage(text="❌ 開始日期不能晚於結束日期", quick_reply=create_date_range_examples_quick_reply()))
                 return
             
             days = (end_date - start_date).days + 1
             if days > 7:
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ 建議查詢 7 天以內", quick_reply=create_date_range_examples_quick_reply()))
+                reply(event, TextSendMessage(text="❌ 建議查詢 7 天以內", quick_reply=create_date_range_examples_quick_reply()))
                 return
             
-            user_states[user_id] = {}
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"🔍 查詢中，預計 {days * 3}-{days * 5} 秒..."))
-            
-            thread = threading.Thread(target=query_historical_async, args=(user_id, start_date, end_date))
-            thread.daemon = True
-            thread.start()
+            # 先清除狀態再排入查詢，避免覆蓋背景查詢寫入的下一頁
+            set_user_state(user_id, {})
+            page_days = min(days, HISTORY_PAGE_DAYS)
+            acknowledge = lambda: reply(event, TextSendMessage(text=f"🔍 查詢中，預計 {page_days * 3}-{page_days * 5} 秒..."))
+            if not submit_historical_query(user_id, start_date, end_date, acknowledge):
+                set_user_state(user_id, user_state)
+                reply(event, TextSendMessage(text=_BUSY_MSG, quick_reply=create_date_range_examples_quick_reply()))
         else:
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ 日期格式錯誤\n\n格式：2025/11/06-2025/11/06", quick_reply=create_date_range_examples_quick_reply()))
+            reply(event, TextSendMessage(text="❌ 日期格式錯誤\n\n格式：2025/11/06-2025/11/06", quick_reply=create_date_range_examples_quick_reply()))
         return
     
-    if text in ["今日", "今天"]:
-        airlink_data = get_current_airlink_data(API_KEY, API_SECRET, STATION_ID)
-        moenv_data = get_current_moenv_data(MOENV_API_TOKEN)
-        all_data = {}
-        if airlink_data:
-            all_data.update(airlink_data)
-        if moenv_data:
-            all_data.update(moenv_data)
-        message = format_air_quality_message(all_data)
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=message, quick_reply=create_main_menu_quick_reply()))
-    
-    elif text in ["歷史查詢", "歷史資料"]:
-        user_states[user_id] = {'waiting_for_date_range': True}
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text="📅 請輸入日期範圍\n\n格式：2025/11/04-2025/11/06\n或：11/4-11/6\n\n💡 建議 7 天以內", quick_reply=create_date_range_examples_quick_reply()))
-    
-    elif text in ["選單", "功能"]:
-        message = "🌟 南區案空氣品質查詢系統\n\n請選擇功能：\n\n📊 今日空品\n📅 歷史查詢\n🌐 開啟系統"
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=message, quick_reply=create_main_menu_quick_reply()))
-    
-    elif text in ["開啟查詢系統", "開啟系統"]:
-        if LIFF_ID:
-            message = f"🌐 完整查詢系統：\nhttps://liff.line.me/{LIFF_ID}"
-        else:
-            message = "⚠️ 請設定 LIFF"
-        line_bot_api.reply_message(event.reply_token, TextSendMessage(text=message, quick_reply=create_main_menu_quick_reply()))
+    command = _COMMANDS.get(text)
+    if command is not None:
+        command(event, user_id, user_state)
+        return
     
+    start_date, end_date = parse_date_range(text)
+    if start_date and end_date:
+        days = (end_date - start_date).days + 1
+        if days > 7:
+            reply(event, TextSendMessage(text="❌ 建議 7 天以內", quick_reply=create_main_menu_quick_reply()))
+            return
+        
+        # 新的查詢取代先前未看完的分頁
+        if user_state:
+            set_user_state(user_id, {})
+        acknowledge = lambda: reply(event, TextSendMessage(text="🔍 查詢中..."))
+        if not submit_historical_query(user_id, start_date, end_date, acknowledge):
+            reply(event, TextSendMessage(text=_BUSY_MSG, quick_reply=create_main_menu_quick_reply()))
     else:
-        start_date, end_date = parse_date_range(text)
-        if start_date and end_date:
-            days = (end_date - start_date).days + 1
-            if days > 7:
-                line_bot_api.reply_message(event.reply_token, TextSendMessage(text="❌ 建議 7 天以內", quick_reply=create_main_menu_quick_reply()))
-                return
-            
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=f"🔍 查詢中..."))
-            thread = threading.Thread(target=query_historical_async, args=(user_id, start_date, end_date))
-            thread.daemon = True
-            thread.start()
-        else:
-            message = "💡 使用說明\n\n• 今日\n• 歷史查詢\n• 選單"
-            line_bot_api.reply_message(event.reply_token, TextSendMessage(text=message, quick_reply=create_main_menu_quick_reply()))
+        message = "💡 使用說明\n\n• 今日\n• 歷史查詢\n• 選單"
+        reply(event, TextSendMessage(text=message, quick_reply=create_main_menu_quick_reply()))
 
 if __name__ == "__main__":
     port = int(os.environ.get('PORT', 10000))
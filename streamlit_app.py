@@ -1,8 +1,6 @@
 import streamlit as st
 import os
 import time
-import hmac
-import hashlib
 import requests
 import pandas as pd
 import datetime
@@ -10,6 +8,10 @@ import urllib3
 import plotly.graph_objects as go
 from PIL import Image
 
+from air_quality_api import (
+    HISTORIC_PM10_FIELDS, HISTORIC_PM25_FIELDS, first_not_none, generate_historic_signature, round1
+)
+
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 # 讀取圖片
@@ -45,16 +47,9 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 
-def generate_signature(api_key, api_secret, t, station_id, start_ts, end_ts):
-    parts = ["api-key", api_key, "end-timestamp", str(end_ts), "start-timestamp", str(start_ts), "station-id",
-             str(station_id), "t", str(t)]
-    data = "".join(parts)
-    return hmac.new(api_secret.encode(), data.encode(), hashlib.sha256).hexdigest()
-
-
 def fetch_airlink_historical(api_key, api_secret, station_id, start_ts, end_ts):
     t = int(time.time())
-    signature = generate_signature(api_key, api_secret, t, station_id, start_ts, end_ts)
+    signature = generate_historic_signature(api_key, api_secret, t, station_id, start_ts, end_ts)
     url = "https://api.weatherlink.com/v2/historic/" + str(station_id)
     params = {"api-key": api_key, "t": t, "start-timestamp": start_ts, "end-timestamp": end_ts,
               "api-signature": signature}
@@ -94,15 +89,15 @@ def fetch_airlink_data(api_key, api_secret, station_id, lsids_dict, start_dt, en
                     timestamp = datetime.datetime.fromtimestamp(record["ts"])
                     date_str = timestamp.strftime("%Y/%m/%d")
                     datetime_str = timestamp.strftime("%Y/%m/%d %H:%M")
-                    pm25 = record.get("pm_2p5_avg") or record.get("pm_2p5") or record.get("pm_2p5_last")
-                    pm10 = record.get("pm_10_avg") or record.get("pm_10") or record.get("pm_10_last")
+                    pm25 = first_not_none(record, HISTORIC_PM25_FIELDS)
+                    pm10 = first_not_none(record, HISTORIC_PM10_FIELDS)
                     if pm25 is not None or pm10 is not None:
                         all_records.append({
                             "device": device_name,
                             "date": date_str,
                             "datetime": datetime_str,
-                            "PM2.5": round(pm25, 1) if pm25 else None,
-                            "PM10": round(pm10, 1) if pm10 else None
+                            "PM2.5": round1(pm25),
+                            "PM10": round1(pm10)
                         })
 
         current_dt = next_dt